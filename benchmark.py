@@ -0,0 +1,406 @@
+"""
+Offline scraping benchmark.
+
+Serves the saved Terrabis host page and Dutchie embed from benchmark_fixtures/
+on a local HTTP server, points the scraper at it (TERRABIS_BASE_URL) and runs
+the real pipeline from script.py against it in headless Chrome: open the
+listing (age gate, iframe, cookies), select the weight, wait for tiles, read
+them, then match the fixture sheet. Reports throughput (rows/min), per-stage
+latency (from stage_tracer) and peak RSS, and can fail on a regression
+against a saved baseline.
+
+The same server answers the Dutchie GraphQL query from the fixture products,
+so --http checks the browser-free DutchieHttpSource (request, paging, parsing
+and retries on injected 503s) without Chrome.
+
+    python benchmark.py
+    python benchmark.py --repeat 3 --warm --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.25
+    python benchmark.py --http --graphql-faults 2
+"""
+import argparse
+import html
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import pandas as pd
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_fixtures")
+FIXTURE_DISPENSARY_ID = "fixture-dispensary"
+FIXTURE_QUERY_HASH = "fixture-filtered-products"
+
+# Fixture category (dtche[category]) → Dutchie product type
+DUTCHIE_TYPES = {
+    "edibles": "Edible",
+    "flower": "Flower",
+    "pre-rolls": "Pre-Rolls",
+    "vaporizers": "Vaporizers",
+}
+
+
+# ---------- Fixture server ----------
+def _read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+def _slug(text):
+    return "-".join("".join(c if c.isalnum() else " " for c in text.lower().replace("&", " and ")).split())
+
+def _price_value(text):
+    return float(text.replace("$", "").replace(",", "")) if text else None
+
+def _thc_content(text):
+    """"THC: 18.6%" / "THC: 100 mg" → Dutchie's THCContent."""
+    match = re.search(r"([\d.]+)\s*(%|mg)", text or "")
+    if not match:
+        return None
+    return {"unit": "PERCENTAGE" if match.group(2) == "%" else "MILLIGRAMS", "range": [float(match.group(1))]}
+
+def dutchie_product(product):
+    """A fixture product in the shape of a FilteredProducts result."""
+    return {
+        "Name": product["name"],
+        "cName": product["slug"],
+        "brandName": product["brand"],
+        "type": DUTCHIE_TYPES[product["category"]],
+        "Options": [o["weight"] for o in product["options"]],
+        "recPrices": [_price_value(o["price"]) for o in product["options"]],
+        "recSpecialPrices": [_price_value(o.get("special")) for o in product["options"]],
+        "THCContent": _thc_content(product["thc"]),
+    }
+
+class FixtureSite:
+    """The recorded pages plus the product list the embed is rendered from."""
+
+    def __init__(self, latency=0.0, graphql_faults=0):
+        self.latency = latency
+        # the first N GraphQL requests answer 503 so the client's retries get exercised
+        self.graphql_faults = graphql_faults
+        self.graphql_requests = 0
+        self.graphql_faults_served = 0
+        self._lock = threading.Lock()
+        self.host_page = _read_fixture("terrabis_host.html")
+        self.embed_page = _read_fixture("dutchie_embed.html")
+        self.card = _read_fixture("dutchie_card.html")
+        self.products = json.loads(_read_fixture("products.json"))
+
+    def listing(self, category, brand):
+        """Products of the dtche[category] / dtche[brands] listing and its weight filter labels."""
+        listed = [
+            p for p in self.products
+            if (not category or p["category"] == category) and (not brand or _slug(p["brand"]) == brand)
+        ]
+        weights = []
+        for product in listed:
+            for option in product["options"]:
+                if option["weight"] not in weights:
+                    weights.append(option["weight"])
+        return listed, weights
+
+    def render_embed(self, query):
+        """The embed listing for dtche[category] / dtche[brands] and the selected weight."""
+        params = dict(parse_qsl(query))
+        weight = params.get("weight")
+        listed, weights = self.listing(params.get("dtche[category]"), params.get("dtche[brands]"))
+        weight_links = "".join(
+            f'<a class="weight__Anchor-sc-10b36p8-0 geHygR" href="?{html.escape(urlencode({**params, "weight": w}))}">{html.escape(w)}</a>'
+            for w in weights
+        )
+
+        cards = []
+        for product in listed:
+            options = [o for o in product["options"] if not weight or o["weight"] == weight]
+            if not options:
+                continue
+            cards.append(
+                self.card.replace("{{url}}", f"/embedded-menu/terrabis-grayville/product/{product['slug']}")
+                .replace("{{brand}}", html.escape(product["brand"]))
+                .replace("{{name}}", html.escape(product["name"]))
+                .replace("{{thc}}", html.escape(product["thc"]))
+                .replace("{{options}}", "".join(self._option_tile(o) for o in options))
+            )
+        return (
+            self.embed_page.replace("{{weights}}", weight_links)
+            .replace("{{products}}", "".join(cards))
+            .replace("{{empty}}", "" if cards else "<p>No products found</p>")
+        )
+
+    def graphql(self, query):
+        """
+        Answers the persisted FilteredProducts query: (status, payload).
+        Checks the operation, hash and dispensary, filters by type and pages by page/perPage.
+        """
+        with self._lock:
+            self.graphql_requests += 1
+            if self.graphql_faults_served < self.graphql_faults:
+                self.graphql_faults_served += 1
+                return 503, {"errors": [{"message": "Service Unavailable"}]}
+        params = dict(parse_qsl(query))
+        try:
+            variables = json.loads(params["variables"])
+            query_hash = json.loads(params["extensions"])["persistedQuery"]["sha256Hash"]
+        except (KeyError, ValueError):
+            return 400, {"errors": [{"message": "malformed persisted query"}]}
+        products_filter = variables.get("productsFilter", {})
+        if params.get("operationName") != "FilteredProducts" or query_hash != FIXTURE_QUERY_HASH:
+            return 200, {"errors": [{"message": "PersistedQueryNotFound"}]}
+        if products_filter.get("dispensaryId") != FIXTURE_DISPENSARY_ID:
+            return 200, {"errors": [{"message": "Dispensary not found"}]}
+        types = products_filter.get("types") or []
+        matching = [dutchie_product(p) for p in self.products if DUTCHIE_TYPES[p["category"]] in types]
+        page, per_page = int(variables.get("page", 0)), int(variables.get("perPage", 50))
+        page_products = matching[page * per_page:(page + 1) * per_page]
+        return 200, {"data": {"filteredProducts": {"products": page_products}}}
+
+    @staticmethod
+    def _option_tile(option):
+        if option.get("special"):
+            price = (f'<span class="optionstyles__OriginalPrice-sc-vu6uvs-2">{option["price"]}</span>'
+                     f'<b>{option["special"]}</b>')
+        else:
+            price = f'<b>{option["price"]}</b>'
+        return f'<button data-testid="option-tile">{html.escape(option["weight"])}\n{price}</button>'
+
+    def handler(self):
+        site = self
+
+        class FixtureHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if site.latency:
+                    time.sleep(site.latency)
+                parts = urlsplit(self.path)
+                status, content_type = 200, "text/html; charset=utf-8"
+                if parts.path.startswith("/order-online/"):
+                    body = site.host_page
+                elif parts.path.startswith("/embedded-menu/") and "/product/" not in parts.path:
+                    body = site.render_embed(parts.query)
+                elif parts.path == "/graphql":
+                    status, payload = site.graphql(parts.query)
+                    body, content_type = json.dumps(payload), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FixtureHandler
+
+def serve_fixtures(latency=0.0, graphql_faults=0):
+    """Starts the fixture site on a free local port. Returns (server, base_url); the site is server.site."""
+    site = FixtureSite(latency, graphql_faults)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), site.handler())
+    server.site = site
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ---------- Benchmark ----------
+def peak_rss_mb():
+    """Peak resident set size of this process and of its reaped children (Chrome, chromedriver)."""
+    # ru_maxrss is reported in kilobytes on Linux
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+def import_script(base_url):
+    """Imports script.py pointed at the fixture server (it reads these at import time)."""
+    os.environ["TERRABIS_BASE_URL"] = base_url
+    os.environ["DUTCHIE_GRAPHQL_URL"] = f"{base_url}/graphql"
+    os.environ["DUTCHIE_EMBED_BASE"] = f"{base_url}/embedded-menu"
+    import script
+    return script
+
+def load_sheet(repeat=1):
+    sheet = pd.read_csv(os.path.join(FIXTURES_DIR, "sheet.csv"), dtype=str)
+    return pd.concat([sheet] * repeat, ignore_index=True)
+
+def run_benchmark(base_url, repeat=1, warm=False):
+    script = import_script(base_url)
+
+    script.warm_session_mode = warm
+    sheet = load_sheet(repeat)
+    groups = script.plan_scrape_groups(sheet, by_listing=True)
+
+    script.stage_tracer.reset()
+    started = time.time()
+    driver, wait = script.get_driver()
+    catalogs = {}
+    try:
+        for group_key, row_indices in groups.items():
+            first_row = sheet.loc[row_indices[0]]
+            driver.current_category = first_row["Category"]
+            script.stage_tracer.set_context(listing=" / ".join(str(part) for part in group_key if part))
+            catalogs[group_key] = script.acquire_product_snapshot(
+                driver, wait, group_key, str(first_row["Brand"]), None, row_indices[0]
+            )
+        matches = script.match_sheet(sheet, catalogs)
+    finally:
+        driver.quit()
+    elapsed = time.time() - started
+
+    stages = script.stage_tracer.summary()
+    return {
+        "rows": len(sheet),
+        "listings": len(groups),
+        "matched_rows": int((matches["urls"].map(len) > 0).sum()),
+        "seconds": round(elapsed, 2),
+        "rows_per_min": round(len(sheet) / elapsed * 60, 1),
+        "warm_session": warm,
+        "stages": stages.to_dict(orient="records"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_http_check(base_url, site, per_page=5):
+    """
+    Reads every fixture listing through DutchieHttpSource (small pages so paging
+    is exercised) and checks it against the listing the browser would see: the
+    same products (the weight link pick_weight_option clicks), their prices and
+    product URLs in the tile href format. Returns (result, problems).
+    """
+    script = import_script(base_url)
+    products_by_name = {p["name"]: p for p in site.products}
+
+    def browser_listing(group_key):
+        website_cat, mapped_brand, normalized_weight = group_key
+        listed, weights = site.listing(script.category_slug_map[website_cat], script.slugify_brand_for_param(mapped_brand))
+        if normalized_weight is None:
+            return {p["name"]: p["options"][0] for p in listed}
+        index, _ = script.pick_weight_option(weights, normalized_weight)
+        if index is None:
+            return {p["name"]: p["options"][0] for p in listed}  # no weight clicked: the unfiltered listing
+        return {p["name"]: o for p in listed for o in p["options"] if o["weight"] == weights[index]}
+
+    sheet = load_sheet()
+    groups = script.plan_scrape_groups(sheet, by_listing=True)
+
+    script.stage_tracer.reset()
+    script.http_product_source = script.DutchieHttpSource(FIXTURE_DISPENSARY_ID, query_hash=FIXTURE_QUERY_HASH, per_page=per_page)
+    problems, catalogs = [], {}
+    started = time.time()
+    try:
+        for group_key in groups:
+            products = script.http_snapshot(group_key)
+            if products is None:
+                problems.append(f"HTTP snapshot failed for {group_key}")
+                continue
+            catalogs[group_key] = products
+            expected_listing = browser_listing(group_key)
+            if {p["name"] for p in products} != set(expected_listing):
+                problems.append(f"{group_key}: HTTP listed {sorted(p['name'] for p in products)}, "
+                                f"the browser listing shows {sorted(expected_listing)}")
+            for product in products:
+                expected = products_by_name.get(product["name"])
+                if expected is None:
+                    problems.append(f"unknown product '{product['name']}' in {group_key}")
+                    continue
+                # the embed's tiles link to <base>/embedded-menu/<dispensary>/product/<slug>
+                tile_href = f"{base_url}/embedded-menu/terrabis-grayville/product/{expected['slug']}"
+                if product["url"] != tile_href:
+                    problems.append(f"URL {product['url']} for '{product['name']}' differs from the tile href {tile_href}")
+                option = expected_listing.get(product["name"])
+                if option is not None and (product["original"], product["discounted"]) != (option["price"], option.get("special") or " "):
+                    problems.append(f"prices {product['original']}/{product['discounted']} for '{product['name']}' not in the fixture")
+        matches = script.match_sheet(sheet, catalogs)
+    finally:
+        script.http_product_source = None
+    elapsed = time.time() - started
+
+    if site.graphql_faults_served < site.graphql_faults:
+        problems.append(f"only {site.graphql_faults_served} of {site.graphql_faults} injected 503(s) were requested")
+    result = {
+        "rows": len(sheet),
+        "listings": len(groups),
+        "matched_rows": int((matches["urls"].map(len) > 0).sum()),
+        "graphql_requests": site.graphql_requests,
+        "graphql_faults_retried": site.graphql_faults_served,
+        "seconds": round(elapsed, 2),
+        "stages": script.stage_tracer.summary().to_dict(orient="records"),
+    }
+    return result, problems
+
+def compare_to_baseline(result, baseline, tolerance):
+    """Regressions beyond `tolerance` (fraction): lower throughput, slower p95 per stage, fewer matches."""
+    problems = []
+    if result["rows_per_min"] < baseline["rows_per_min"] * (1 - tolerance):
+        problems.append(f"throughput {result['rows_per_min']} rows/min vs baseline {baseline['rows_per_min']}")
+    if result["matched_rows"] < baseline["matched_rows"]:
+        problems.append(f"matched rows {result['matched_rows']} vs baseline {baseline['matched_rows']}")
+    baseline_p95 = {s["stage"]: s["p95_s"] for s in baseline["stages"]}
+    for s in result["stages"]:
+        before = baseline_p95.get(s["stage"])
+        # small absolute slack so millisecond-level stages don't flap
+        if before is not None and s["p95_s"] > before * (1 + tolerance) + 0.05:
+            problems.append(f"stage '{s['stage']}' p95 {s['p95_s']}s vs baseline {before}s")
+    return problems
+
+def print_report(result):
+    print(f"\nRows: {result['rows']} in {result['listings']} listing(s), {result['matched_rows']} matched")
+    print(f"Time: {result['seconds']}s  →  {result['rows_per_min']} rows/min")
+    print(f"Peak RSS: {result['peak_rss_mb']['self']} MB (python), {result['peak_rss_mb']['children']} MB (largest child)")
+    print("\nStage latency:")
+    print(pd.DataFrame(result["stages"]).to_string(index=False))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline scraping benchmark against saved Terrabis/Dutchie fixtures.")
+    parser.add_argument("--repeat", type=int, default=1, help="repeat the fixture sheet N times")
+    parser.add_argument("--warm", action="store_true", help="switch listings inside the embed (warm session)")
+    parser.add_argument("--latency", type=float, default=0.0, help="artificial server latency per request, seconds")
+    parser.add_argument("--output", help="write the result as JSON (e.g. to use as a baseline)")
+    parser.add_argument("--baseline", help="JSON from an earlier run; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression vs baseline (fraction)")
+    parser.add_argument("--http", action="store_true", help="check the Dutchie HTTP source against the fixture GraphQL endpoint (no Chrome)")
+    parser.add_argument("--graphql-faults", type=int, default=2, help="with --http, answer the first N GraphQL requests with 503")
+    args = parser.parse_args(argv)
+
+    if args.http:
+        server, base_url = serve_fixtures(args.latency, graphql_faults=args.graphql_faults)
+        try:
+            result, problems = run_http_check(base_url, server.site)
+        finally:
+            server.shutdown()
+        print(f"\nHTTP source: {result['listings']} listing(s), {result['matched_rows']} of {result['rows']} row(s) matched")
+        print(f"GraphQL: {result['graphql_requests']} request(s), {result['graphql_faults_retried']} injected 503(s) retried")
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            if result["matched_rows"] < baseline["matched_rows"]:
+                problems.append(f"matched rows {result['matched_rows']} vs browser baseline {baseline['matched_rows']}")
+        for problem in problems:
+            print(f"FAILED: {problem}")
+        return 1 if problems else 0
+
+    server, base_url = serve_fixtures(args.latency)
+    try:
+        result = run_benchmark(base_url, repeat=args.repeat, warm=args.warm)
+    finally:
+        server.shutdown()
+
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare_to_baseline(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        return 1 if problems else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
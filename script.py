@@ -50,6 +50,8 @@ import time
 import io
 import streamlit as st
 import pandas as pd
+import numpy as np
+from scipy import sparse
 import undetected_chromedriver as uc
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
@@ -59,11 +61,32 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.action_chains import ActionChains
 from openpyxl import load_workbook 
-from openpyxl.utils import get_column_letter # Add this import
 from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.support import expected_conditions as EC
 import os, subprocess, re
-from urllib.parse import urlencode
+import hashlib
+import json
+import csv
+import difflib
+import fnmatch
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+import asyncio
+import contextvars
+import copy
+import queue
+import shutil
+import sqlite3
+import tempfile
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 # import os, subprocess, re
 
 def _find_chrome_binary():
@@ -88,13 +111,97 @@ def _chrome_major(chrome_bin):
 # -----------------------------------
 
 
+# ---------- Stage timing ----------
+class StageTracer:
+    """
+    Records how long each scraping stage takes (navigation, age gate, iframe,
+    filters, tile wait, extraction, matching, Excel save). Each record carries the
+    current context (listing / row) so durations can be attributed. The context is
+    a ContextVar, so it is kept per thread and per asyncio task (Playwright engine).
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._context = contextvars.ContextVar("stage_context", default={})
+
+    def set_context(self, **fields):
+        """Context attached to every stage recorded on this thread / asyncio task from now on."""
+        self._context.set(fields)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            record = {
+                "stage": name,
+                "seconds": round(time.perf_counter() - started, 4),
+                "ok": ok,
+                "thread": threading.current_thread().name,
+                "at": time.time(),
+                **self._context.get(),
+            }
+            with self._lock:
+                self.records.append(record)
+
+    def traced(self, name):
+        """Decorator form of stage()."""
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    def summary(self):
+        """Per-stage count, p50, p95 and total seconds."""
+        with self._lock:
+            records = list(self.records)
+        if not records:
+            return pd.DataFrame(columns=["stage", "count", "p50_s", "p95_s", "total_s"])
+        frame = pd.DataFrame(records)
+        grouped = frame.groupby("stage", sort=False)["seconds"]
+        return pd.DataFrame({
+            "count": grouped.count(),
+            "p50_s": grouped.quantile(0.5).round(3),
+            "p95_s": grouped.quantile(0.95).round(3),
+            "total_s": grouped.sum().round(2),
+        }).sort_values("total_s", ascending=False).reset_index()
+
+    def to_jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(record, default=str) + "\n" for record in self.records)
+
+    def to_csv(self):
+        with self._lock:
+            records = list(self.records)
+        out = io.StringIO()
+        fields = ["stage", "seconds"] + sorted({k for record in records for k in record} - {"stage", "seconds"})
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(records)
+        return out.getvalue()
+
+stage_tracer = StageTracer()
+traced = stage_tracer.traced
+
 # ---------- Headless helpers ----------
 from selenium.common.exceptions import WebDriverException
 
 def stable_click(driver, elem):
     """Scroll into view, try normal click, fallback to JS click (headless-safe)."""
-    driver.execute_script("arguments[0].scrollIntoView({block:'center', inline:'center'});", elem)
-    time.sleep(0.2)
+    driver.execute_script("arguments[0].scrollIntoView({block:'center', inline:'center', behavior:'instant'});", elem)
     try:
         elem.click()
         return True
@@ -112,6 +219,190 @@ def wait_present(driver, locator, timeout=20):
     return WebDriverWait(driver, timeout).until(EC.presence_of_element_located(locator))
 # --------------------------------------
 
+# ---------- Readiness waits ----------
+# Resolves once the page has had no DOM mutations and no new network requests for
+# `quietMs`, or after `timeoutMs` at the latest. Returns {quiet, elapsed} in ms.
+DOM_QUIET_JS = """
+const quietMs = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+const start = performance.now();
+let last = start;
+const bump = () => { last = performance.now(); };
+const mo = new MutationObserver(bump);
+mo.observe(document.documentElement || document, {childList: true, subtree: true, characterData: true});
+let po = null;
+try {
+    po = new PerformanceObserver(bump);
+    po.observe({type: 'resource', buffered: false});
+} catch (e) {}
+const tick = () => {
+    const now = performance.now();
+    if (now - last >= quietMs || now - start >= timeoutMs) {
+        mo.disconnect();
+        if (po) po.disconnect();
+        done({quiet: now - last >= quietMs, elapsed: now - start});
+    } else {
+        setTimeout(tick, 50);
+    }
+};
+setTimeout(tick, 50);
+"""
+
+def report_wait(label, started, ready=True):
+    """Logs how long a readiness wait actually took."""
+    elapsed = time.time() - started
+    print(f"⏱ {label}: {elapsed:.2f}s{'' if ready else ' (gave up, continuing)'}")
+    return elapsed
+
+def wait_for_dom_quiet(driver, quiet=0.5, timeout=8, label="DOM quiet"):
+    """
+    Waits until the current document stops mutating and stops loading resources
+    for `quiet` seconds. Falls back to a short bounded sleep if the observer
+    cannot be installed (e.g. the frame navigated away mid-wait).
+    """
+    started = time.time()
+    ready = False
+    try:
+        driver.set_script_timeout(timeout + 5)
+        result = driver.execute_async_script(DOM_QUIET_JS, int(quiet * 1000), int(timeout * 1000)) or {}
+        ready = bool(result.get("quiet"))
+    except WebDriverException as e:
+        print(f"DOM-quiet observer unavailable ({e.__class__.__name__}); falling back to a bounded sleep.")
+        time.sleep(min(quiet * 2, timeout))
+    return report_wait(label, started, ready)
+
+def wait_for_page_ready(driver, timeout=20, label="Page ready"):
+    """
+    Waits for document.readyState to leave 'loading', then for the DOM to go quiet.
+    """
+    started = time.time()
+    try:
+        WebDriverWait(driver, timeout).until(
+            lambda d: d.execute_script("return document.readyState") in ("interactive", "complete")
+        )
+    except TimeoutException:
+        report_wait(label, started, False)
+        return time.time() - started
+    wait_for_dom_quiet(driver, timeout=max(1, timeout - (time.time() - started)), label=f"{label} (DOM quiet)")
+    return report_wait(label, started)
+
+@traced("tiles_settle")
+def wait_for_tiles_settled(driver, selector="div[data-testid='product-list-item']:not([data-warm-stale])", timeout=10, stable_polls=3, label="Product tiles settled"):
+    """
+    Waits until the number of product tiles stops changing for `stable_polls`
+    consecutive polls and the listing's DOM goes quiet (prices/options hydrated).
+    Returns the final tile count.
+    """
+    started = time.time()
+    state = {"count": -1, "stable": 0}
+
+    def _count_is_stable(d):
+        count = len(d.find_elements(By.CSS_SELECTOR, selector))
+        if count and count == state["count"]:
+            state["stable"] += 1
+        else:
+            state["count"], state["stable"] = count, 0
+        return state["stable"] >= stable_polls
+
+    ready = True
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.25).until(_count_is_stable)
+    except TimeoutException:
+        ready = False
+    if ready:
+        wait_for_dom_quiet(driver, quiet=0.4, timeout=max(1, timeout - (time.time() - started)), label=f"{label} (DOM quiet)")
+    report_wait(f"{label} [{max(state['count'], 0)} tiles]", started, ready)
+    return max(state["count"], 0)
+
+# ---------- Adaptive timeouts ----------
+# True when the listing has rendered its empty state instead of product tiles
+EMPTY_LISTING_JS = """
+if (document.querySelector("div[data-testid='product-list-item']:not([data-warm-stale])")) return false;
+const body = document.body ? document.body.innerText : "";
+return /no products found|no products (are )?available|no results found|couldn.t find any (products|results)/i.test(body);
+"""
+
+class AdaptiveTimeouts:
+    """
+    Per-wait-type latency samples from this run. Once a wait type has
+    `min_samples` successful waits, its deadline becomes p99 × `factor` +
+    `margin` seconds (never below `floor`, never above the hard-coded default),
+    so a wait that is not going to succeed gives up in seconds, not a minute.
+    A wait that times out at a learned deadline keeps waiting up to the default
+    once; if it then succeeds, its full duration is recorded, so a slow but
+    healthy page widens the deadline instead of being dropped.
+    """
+
+    def __init__(self, quantile=0.99, factor=1.5, margin=2.0, floor=3.0, min_samples=5, window=200):
+        self.quantile = quantile
+        self.factor = factor
+        self.margin = margin
+        self.floor = floor
+        self.min_samples = min_samples
+        self.window = window
+        self._samples = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(kind, [])
+            samples.append(seconds)
+            del samples[:-self.window]
+
+    def timeout(self, kind, default):
+        with self._lock:
+            samples = list(self._samples.get(kind, []))
+        if len(samples) < self.min_samples:
+            return default
+        learned = float(np.quantile(samples, self.quantile)) * self.factor + self.margin
+        return min(default, max(self.floor, learned))
+
+    def retried(self, kind):
+        """Counts a wait that outlived its learned deadline."""
+        with self._lock:
+            self._retries[kind] = self._retries.get(kind, 0) + 1
+
+    def wait(self, driver, kind, condition, default, poll_frequency=0.2):
+        """
+        WebDriverWait(...).until(condition) with the learned deadline, retried once
+        up to the default deadline on a timeout; successful waits are recorded.
+        """
+        started = time.time()
+        deadline = self.timeout(kind, default)
+        try:
+            result = WebDriverWait(driver, deadline, poll_frequency=poll_frequency).until(condition)
+        except TimeoutException:
+            if deadline >= default:
+                raise
+            self.retried(kind)
+            print(f"'{kind}' wait outlived its learned {deadline:.1f}s deadline; waiting up to {default}s.")
+            result = WebDriverWait(driver, default - deadline, poll_frequency=poll_frequency).until(condition)
+        self.observe(kind, time.time() - started)
+        return result
+
+    def summary(self):
+        with self._lock:
+            kinds = {kind: list(samples) for kind, samples in self._samples.items()}
+            retries = dict(self._retries)
+        return pd.DataFrame([
+            {"wait": kind, "samples": len(samples), "p99_s": round(float(np.quantile(samples, self.quantile)), 2),
+             "deadline_s": round(self.timeout(kind, float("inf")), 2) if len(samples) >= self.min_samples else None,
+             "retries": retries.get(kind, 0)}
+            for kind, samples in kinds.items()
+        ], columns=["wait", "samples", "p99_s", "deadline_s", "retries"])
+
+adaptive_timeouts = AdaptiveTimeouts()
+
+def listing_tiles_or_empty(driver):
+    """Wait condition: "tiles" once product tiles render, "empty" on the empty-listing state, else False."""
+    if driver.find_elements(By.CSS_SELECTOR, "div[data-testid='product-list-item']:not([data-warm-stale])"):
+        return "tiles"
+    try:
+        return "empty" if driver.execute_script(EMPTY_LISTING_JS) else False
+    except WebDriverException:
+        return False
+# --------------------------------------
+
 def type_react_input(driver, el, text):
     """
     Sets value on a React-controlled <input> and dispatches the right events so filtering happens in headless too.
@@ -126,54 +417,137 @@ def type_react_input(driver, el, text):
     el.dispatchEvent(new Event('change', {bubbles: true}));
     """, el, text)
 
-def click_show_more_until_exhausted(driver):
-    """
-    Some filters hide brands behind a 'Show more' button.
-    Click it repeatedly if present.
-    """
-    import time
-    while True:
-        try:
-            btn = driver.find_element(By.XPATH, "//button[contains(., 'Show more') or contains(., 'More')]")
-            if btn.is_displayed() and btn.is_enabled():
-                driver.execute_script("arguments[0].scrollIntoView({block:'center'});", btn)
-                time.sleep(0.2)
-                stable_click(driver, btn)
-                time.sleep(0.6)
-            else:
-                break
-        except NoSuchElementException:
-            break
+# Expands the filter panel's brand list once ('Show more' / virtualized scrolling)
+# while reading every label in the page, all inside one async script call.
+# Resolves with {element, id, labels}: the matching label (exact text first,
+# else the first label containing the brand), its checkbox id, and every label
+# seen as normalized text → checkbox id.
+BRAND_FACET_JS = """
+const target = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+const norm = s => (s || "").toLowerCase().split(/\\s+/).filter(Boolean).join(" ").replace(/\\s*\\(\\d+\\)$/, "");
+const labels = {};
+let partial = null;
+const brandsButton = Array.from(document.querySelectorAll("button")).find(b => /Brands/.test(b.innerText || ""));
+const panel = brandsButton ? brandsButton.nextElementSibling : null;
+// only the brand facet's own labels (other facets and the page have labels too)
+const root = panel || document;
+const scan = () => {
+    for (const lbl of root.querySelectorAll("label")) {
+        const text = norm(lbl.innerText);
+        if (!text) continue;
+        if (lbl.htmlFor) labels[text] = lbl.htmlFor;
+        if (text === target) return lbl;
+        if (!partial && text.includes(target) && lbl.offsetParent !== null) partial = lbl;
+    }
+    return null;
+};
+// complete: the whole list was expanded and read (not cut off by the timeout)
+const finish = (lbl, complete) => {
+    if (lbl && !lbl.isConnected && lbl.htmlFor) {
+        lbl = root.querySelector(`label[for="${CSS.escape(lbl.htmlFor)}"]`);
+    }
+    if (lbl) lbl.scrollIntoView({block: 'center', inline: 'center', behavior: 'instant'});
+    done({element: lbl || null, id: lbl ? (lbl.htmlFor || null) : null, labels: labels,
+          scoped: !!panel, complete: !!complete});
+};
+const controls = panel && panel.parentElement ? panel.parentElement : document;
+const start = performance.now();
+let lastCount = -1, idle = 0, fruitlessClicks = 0;
+const step = () => {
+    const exact = scan();
+    if (exact) return finish(exact, false);
+    if (performance.now() - start > timeoutMs) return finish(partial, false);
+    const count = root.querySelectorAll("label").length;
+    const more = fruitlessClicks < 3 && Array.from(controls.querySelectorAll("button")).find(b =>
+        /Show more|More/.test(b.innerText || "") && !b.disabled && b.offsetParent !== null);
+    if (more) {
+        fruitlessClicks = count > lastCount ? 0 : fruitlessClicks + 1;
+        more.click();
+    } else if (panel && panel.scrollTop + panel.clientHeight < panel.scrollHeight - 1) {
+        panel.scrollTop += panel.clientHeight;
+    } else if (!panel && window.innerHeight + window.scrollY < document.documentElement.scrollHeight - 1) {
+        window.scrollBy(0, 600);
+    } else if (count === lastCount && ++idle >= 3) {
+        // nothing left to expand or scroll and no new labels arrived
+        return finish(partial, true);
+    }
+    lastCount = count;
+    setTimeout(step, 60);
+};
+step();
+"""
+
+def normalize_label_text(text):
+    """Label text as BRAND_FACET_JS keys it: lower-case, single spaces, no trailing '(count)'."""
+    return re.sub(r"\s*\(\d+\)$", "", " ".join(str(text).lower().split()))
 
-def scroll_filter_panel_to_find_label(driver, brand_text, max_scrolls=30):
+class BrandFacetResolver:
     """
-    When the brand list is virtualized, we need to scroll the panel to load more labels.
+    Finds a brand's checkbox label in the filter panel. The full brand list is
+    expanded and searched in a single script call, and every label seen is
+    cached per category as brand → checkbox id, so later lookups in the same
+    category try a direct `label[for=id]` query first. The cache is keyed by the
+    website category, whether callers pass the sheet's ("FLOWER") or the site's ("Flower").
     """
-    import time
-    # The list container is usually the element right after the 'Brands' button
-    try:
-        panel = driver.find_element(By.XPATH, "//button[contains(., 'Brands')]/following-sibling::*[1]")
-    except NoSuchElementException:
-        panel = None
-
-    brand_norm = " ".join(brand_text.lower().split())
-
-    for _ in range(max_scrolls):
-        # Try to find the label in the currently loaded chunk
-        labels = driver.find_elements(By.XPATH, "//label")
-        for lbl in labels:
-            t = " ".join(lbl.text.lower().split())
-            if brand_norm in t and lbl.is_displayed():
-                stable_click(driver, lbl)
-                return True
-        # If we can scroll a dedicated panel, do that; otherwise scroll window
-        if panel:
-            driver.execute_script("arguments[0].scrollTop = arguments[0].scrollTop + arguments[0].clientHeight;", panel)
-        else:
-            driver.execute_script("window.scrollBy(0, 600);")
-        time.sleep(0.4)
 
-    return False
+    def __init__(self):
+        self._facets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _category_key(category):
+        return category_mapping.get(str(category).upper(), category) if category else category
+
+    def resolve(self, driver, category, brand_text, timeout=8):
+        """The brand's <label> element (or None) and its checkbox id."""
+        category = self._category_key(category)
+        target = normalize_label_text(brand_text)
+        with self._lock:
+            ids = dict(self._facets.get(category, {}))
+        checkbox_id = ids.get(target) or next((i for text, i in ids.items() if target in text), None)
+        if checkbox_id:
+            found = driver.find_elements(By.CSS_SELECTOR, f"label[for='{checkbox_id}']")
+            if found:
+                return found[0], checkbox_id
+        result = self._scan(driver, category, target, timeout)
+        return result.get("element"), result.get("id")
+
+    def _scan(self, driver, category, target, timeout):
+        category = self._category_key(category)
+        driver.set_script_timeout(timeout + 5)
+        result = driver.execute_async_script(BRAND_FACET_JS, target, int(timeout * 1000)) or {}
+        with self._lock:
+            self._facets.setdefault(category, {}).update(result.get("labels") or {})
+        print(f"Brand facet: {len(result.get('labels') or {})} label(s) read for '{category}'.")
+        return result
+
+    def labels(self, driver, category, timeout=12):
+        """
+        Every brand label of the (expanded) facet list as normalized text → checkbox id,
+        and whether that list is complete: read from the brand panel itself and
+        fully expanded before the timeout.
+        """
+        result = self._scan(driver, category, "", timeout)
+        with self._lock:
+            labels = dict(self._facets.get(self._category_key(category), {}))
+        return labels, bool(result.get("scoped") and result.get("complete"))
+
+    def select(self, driver, category, brand_text):
+        """Ticks the brand's checkbox. Returns True if the brand was found."""
+        label, checkbox_id = self.resolve(driver, category, brand_text)
+        if label is None:
+            return False
+        checked = driver.execute_script(
+            "const cb = arguments[0] && document.getElementById(arguments[0]); return cb ? cb.checked : null;",
+            checkbox_id
+        )
+        if checked:
+            print(f"ℹ️ Already selected: {label.text}")
+            return True
+        stable_click(driver, label)
+        return True
+
+brand_facets = BrandFacetResolver()
 
 # ---- URL helpers to pre-filter brand/category on Terrabis ----
 category_slug_map = {
@@ -198,9 +572,12 @@ def slugify_brand_for_param(name: str | None) -> str | None:
     s = re.sub(r"-+", "-", s).strip("-")
     return s
 
+# Host serving the order-online pages; overridden to point at local fixtures (benchmark.py)
+TERRABIS_BASE_URL = os.environ.get("TERRABIS_BASE_URL", "https://terrabis.co").rstrip("/")
+
 def build_terrabis_url(city_slug: str, category_site_name: str, brand_site_name: str | None) -> str:
     cat_slug = category_slug_map.get(category_site_name, category_site_name.lower())
-    base = f"https://terrabis.co/order-online/{city_slug}/"
+    base = f"{TERRABIS_BASE_URL}/order-online/{city_slug}/"
     params = {
         "dtche[category]": cat_slug,
         "dtche[sortby]": "relevance",
@@ -210,14 +587,16 @@ def build_terrabis_url(city_slug: str, category_site_name: str, brand_site_name:
         params["dtche[brands]"] = bslug
     return f"{base}?{urlencode(params)}"
 
+@traced("open_listing")
 def open_terrabis_with_brand(driver, wait, city_slug: str, category_site_name: str, brand_site_name: str | None, row_index: int) -> bool:
     """
     Navigate to Terrabis with category (+ optional brand) applied via query params.
     Stay on Terrabis, switch into the Dutchie iframe, and wait for product tiles.
     """
     url = build_terrabis_url(city_slug, category_site_name, brand_site_name)
-    driver.switch_to.default_content()
-    driver.get(url)
+    with stage_tracer.stage("navigate"):
+        driver.switch_to.default_content()
+        driver.get(url)
 
     # Close age gate on host page
     try:
@@ -226,35 +605,40 @@ def open_terrabis_with_brand(driver, wait, city_slug: str, category_site_name: s
         pass
 
     try:
-        iframe = WebDriverWait(driver, 25).until(
-            EC.presence_of_element_located((
+        with stage_tracer.stage("iframe_switch"):
+            iframe = adaptive_timeouts.wait(driver, "iframe", EC.presence_of_element_located((
                 By.CSS_SELECTOR,
                 "iframe#dutchie--embed__iframe, iframe[id*='dutchie'], iframe[src*='dutchie.com/embedded-menu']"
-            ))
-        )
-        WebDriverWait(driver, 25).until(EC.frame_to_be_available_and_switch_to_it(iframe))
-        st.info(f"Switched to Dutchie iframe for row {row_index}.")
+            )), 25)
+            adaptive_timeouts.wait(driver, "iframe_switch", EC.frame_to_be_available_and_switch_to_it(iframe), 25)
+            st.info(f"Switched to Dutchie iframe for row {row_index}.")
 
-        # settle + optional cookie
-        try:
-            WebDriverWait(driver, 10).until(lambda d: d.execute_script("return document.readyState") in ("interactive", "complete"))
-        except Exception:
-            pass
+            # settle
+            try:
+                adaptive_timeouts.wait(driver, "frame_ready", lambda d: d.execute_script("return document.readyState") in ("interactive", "complete"), 10)
+            except Exception:
+                pass
+
+        # optional cookie
         try:
             cookie_btn = WebDriverWait(driver, 4).until(EC.element_to_be_clickable((
                 By.XPATH, "//button[normalize-space()='Accept' or contains(translate(.,'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'accept')]"
             )))
             stable_click(driver, cookie_btn)
-            time.sleep(0.4)
+            started = time.time()
+            WebDriverWait(driver, 3).until(EC.invisibility_of_element(cookie_btn))
+            report_wait("Cookie banner dismissed", started)
         except Exception:
             pass
 
-        # wait for tiles
-        WebDriverWait(driver, 35).until(EC.any_of(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-testid='product-list-item']")),
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, "[data-testid*='product'][data-testid*='item']"))
-        ))
-        time.sleep(0.8)
+        # wait for tiles (or the empty-listing state, which returns just as early)
+        with stage_tracer.stage("tile_wait"):
+            state = adaptive_timeouts.wait(driver, "listing", EC.any_of(
+                listing_tiles_or_empty,
+                EC.presence_of_all_elements_located((By.CSS_SELECTOR, "[data-testid*='product'][data-testid*='item']"))
+            ), 35)
+        if state == "empty":
+            print(f"Listing for row {row_index} is empty.")
         return True
 
     except TimeoutException as e:
@@ -269,6 +653,126 @@ def open_terrabis_with_brand(driver, wait, city_slug: str, category_site_name: s
         return False
 
 
+# ---------- Warm session (stay inside the Dutchie embed) ----------
+# Pushes a new URL onto the embed's history and fires popstate, so the menu's
+# client-side router re-renders the listing without reloading the document.
+IN_APP_NAVIGATE_JS = """
+const url = arguments[0];
+document.querySelectorAll("div[data-testid='product-list-item']").forEach(t => t.setAttribute('data-warm-stale', '1'));
+if (url !== window.location.href) {
+    history.pushState(history.state, '', url);
+    window.dispatchEvent(new PopStateEvent('popstate', {state: history.state}));
+}
+"""
+
+# True once the listing has re-rendered (fresh tiles) after IN_APP_NAVIGATE_JS
+FRESH_TILES_JS = """
+return document.querySelectorAll("div[data-testid='product-list-item']:not([data-warm-stale])").length > 0;
+"""
+
+class WarmSession:
+    """
+    Per-driver memory of the last embed location opened the cold way (host page,
+    age gate, iframe, cookies) and which category/brand slugs it was opened with.
+    Later listings swap those slugs in the embed URL and navigate in-app.
+    """
+
+    def __init__(self):
+        self.embed_url = None
+        self.category_slug = None
+        self.brand_slug = None
+
+    def reset(self):
+        self.embed_url = self.category_slug = self.brand_slug = None
+
+    def remember(self, driver, category_site_name, brand_site_name):
+        try:
+            self.embed_url = driver.execute_script("return window.location.href")
+        except WebDriverException:
+            self.reset()
+            return
+        self.category_slug = category_slug_map.get(category_site_name, category_site_name.lower())
+        self.brand_slug = slugify_brand_for_param(brand_site_name)
+
+    def url_for(self, category_site_name, brand_site_name):
+        """
+        Embed URL for another category/brand, or None when it cannot be derived
+        (no warm location yet, or the old slugs do not appear in it).
+        """
+        if not self.embed_url or not self.brand_slug:
+            return None
+        new_brand = slugify_brand_for_param(brand_site_name)
+        if not new_brand:
+            return None
+        new_category = category_slug_map.get(category_site_name, category_site_name.lower())
+        swaps = {self.brand_slug: new_brand, self.category_slug: new_category}
+
+        parts = urlsplit(self.embed_url)
+        path_segments = parts.path.split("/")
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        if self.brand_slug not in path_segments and not any(
+            self.brand_slug in v.split(",") for _, v in query
+        ):
+            return None
+        path = "/".join(swaps.get(seg, seg) for seg in path_segments)
+        query = [(k, ",".join(swaps.get(item, item) for item in v.split(","))) for k, v in query]
+        return urlunsplit((parts.scheme, parts.netloc, path, urlencode(query, safe=",[]"), parts.fragment))
+
+def get_warm_session(driver):
+    session = getattr(driver, "warm_session", None)
+    if session is None:
+        session = driver.warm_session = WarmSession()
+    return session
+
+# Set from the sidebar
+warm_session_mode = False
+
+@traced("open_listing_warm")
+def navigate_listing_in_app(driver, url, timeout=12):
+    """
+    Changes the listing from inside the embed. Returns "tiles" once fresh tiles
+    render, "empty" on the empty-listing state, or False if the menu did not
+    react (caller falls back to a full load).
+    """
+    try:
+        driver.execute_script(IN_APP_NAVIGATE_JS, url)
+        return adaptive_timeouts.wait(
+            driver, "warm_listing",
+            lambda d: (d.execute_script(FRESH_TILES_JS) and "tiles") or (d.execute_script(EMPTY_LISTING_JS) and "empty"), timeout
+        )
+    except (TimeoutException, WebDriverException) as e:
+        print(f"In-app navigation did not render a new listing ({e.__class__.__name__}); reloading.")
+        return False
+
+def open_listing(driver, wait, category_site_name, brand_site_name, row_index):
+    """
+    Opens a filtered listing. In warm-session mode the host page, age gate and
+    iframe bootstrap are paid once; later brands are switched inside the embed.
+    """
+    if warm_session_mode:
+        session = get_warm_session(driver)
+        url = session.url_for(category_site_name, brand_site_name)
+        state = navigate_listing_in_app(driver, url) if url else False
+        if state == "empty" and not brand_confirmed(category_site_name, brand_site_name):
+            # an unknown brand slug looks just like an empty listing: confirm with a full load
+            print(f"In-app listing for '{brand_site_name}' is empty and the brand is unconfirmed; reloading.")
+            state = False
+        if state:
+            st.info(f"Switched listing in-app for row {row_index}.")
+            return True
+        session.reset()
+
+    opened = open_terrabis_with_brand(
+        driver, wait,
+        city_slug="grayville",
+        category_site_name=category_site_name,
+        brand_site_name=brand_site_name,
+        row_index=row_index
+    )
+    if opened and warm_session_mode:
+        get_warm_session(driver).remember(driver, category_site_name, brand_site_name)
+    return opened
+
 def open_dutchie_menu(driver, wait, timeout=60):
     """
     Robustly enter the Dutchie menu.
@@ -346,6 +850,11 @@ STOPWORDS = {
     'a','an','and','at','by','for','in','of','on','or','the','to','with', 'sample', 'hybrid', 'indica', 'sativa', 'pre', 'pod', 'popcorn', 'shake', 'pills'
 }
 
+# Keyword-score thresholds: names with few keywords get a looser threshold
+FEW_TOKENS_MAX = 3
+MATCH_THRESHOLD_FEW_TOKENS = 0.6    # 60% when <= FEW_TOKENS_MAX Excel tokens
+MATCH_THRESHOLD_MANY_TOKENS = 0.75  # 75% otherwise
+
 # Define a list of common flavors
 FLAVOR_LIST = [
     'apple', 'banana', 'berry', 'raspberry', 'blueberry', 'bubblegum', 'cherry', 'chocolate',
@@ -378,79 +887,479 @@ no_weight_categories = ['Edibles', 'Topicals', 'Accessories', 'Apparel']
 # Global buffer to hold the Excel file in memory
 excel_buffer = None
 
+# Open workbook that collects the scraped results for the current run
+results_writer = None
+
+# Result columns in "Pricing Research": AY is column 51, AZ is 52, BA is 53, BB is 54
+COL_ORIGINAL_PRICE = 51    # AY
+COL_DISCOUNTED_PRICE = 52  # AZ
+COL_THC_CONTENT = 53       # BA
+COL_PRODUCT_URL = 54       # BB
+
 def save_updated_excel_to_memory(uploaded_file):
     """
     Loads the uploaded Excel file into an in-memory BytesIO buffer.
     This buffer will be used and updated throughout the scraping process.
     """
-    global excel_buffer
+    global excel_buffer, results_writer
     excel_buffer = io.BytesIO(uploaded_file.getvalue())
+    results_writer = None  # a fresh upload starts a fresh results workbook
     print("Excel file loaded into memory for updates.")
 
-def save_data_to_file(row_index, discounted_price, original_price, product_thc, product_url):
+def _cell_value(value):
+    """Handle multiple values by joining them with commas."""
+    return ", ".join(map(str, value)) if isinstance(value, list) else value
+
+class ExcelResultsWriter:
     """
-    Updates a specific row in the in-memory Excel workbook with scraped data.
+    Keeps the "Pricing Research" workbook open for the whole run.
+    Rows are written straight into the open sheet (columns AY–BB) and the
+    workbook is only serialized back into `excel_buffer` on flush(), either
+    every `checkpoint_every` rows or once at the end of the run.
     """
-    global excel_buffer
-    if excel_buffer is None:
-        st.error("Error: Excel buffer not initialized. Please upload a file first.")
-        return
 
-    try:
-        # Load the workbook from the in-memory BytesIO object
-        excel_buffer.seek(0) # Go to the beginning of the buffer
-        wb = load_workbook(excel_buffer)
-        
-        # Select the specific sheet named "Pricing Research"
-        sheet_name = "Pricing Research"
-        if sheet_name not in wb.sheetnames:
+    def __init__(self, buffer, sheet_name="Pricing Research", checkpoint_every=0):
+        buffer.seek(0)
+        self.wb = load_workbook(buffer)
+        if sheet_name not in self.wb.sheetnames:
             st.warning(f"Warning: Sheet '{sheet_name}' not found. Creating it.")
-            ws = wb.create_sheet(sheet_name)
+            self.ws = self.wb.create_sheet(sheet_name)
         else:
-            ws = wb[sheet_name]
+            self.ws = self.wb[sheet_name]
+        self.checkpoint_every = int(checkpoint_every or 0)
+        self.pending = 0
 
-        # openpyxl uses 1-based indexing for rows and columns
+    def write_row(self, row_index, discounted_price, original_price, product_thc, product_url):
         # The row_index from pandas is 0-based, so add 2 for Excel (1 for header, 1 for 0-base to 1-base)
         excel_row = row_index + 2
-
-        # Define the target columns (AS, AT, AU, AV)
-        # AY is column 51, AZ is 52, BA is 53, BB is 54
-        col_original_price = get_column_letter(51)   # AY
-        col_discounted_price = get_column_letter(52) # AZ
-        col_thc_content = get_column_letter(53)      # BA
-        col_product_url = get_column_letter(54)      # BB
-
-        # Handle multiple values by joining them with commas
-        ws[f"{col_discounted_price}{excel_row}"] = ", ".join(map(str, discounted_price)) if isinstance(discounted_price, list) else discounted_price
-        ws[f"{col_original_price}{excel_row}"] = ", ".join(map(str, original_price)) if isinstance(original_price, list) else original_price
-        ws[f"{col_thc_content}{excel_row}"] = ", ".join(map(str, product_thc)) if isinstance(product_thc, list) else product_thc
-        ws[f"{col_product_url}{excel_row}"] = ", ".join(map(str, product_url)) if isinstance(product_url, list) else product_url
-
-        # Save the modified workbook back to the BytesIO buffer
+        self.ws.cell(row=excel_row, column=COL_DISCOUNTED_PRICE, value=_cell_value(discounted_price))
+        self.ws.cell(row=excel_row, column=COL_ORIGINAL_PRICE, value=_cell_value(original_price))
+        self.ws.cell(row=excel_row, column=COL_THC_CONTENT, value=_cell_value(product_thc))
+        self.ws.cell(row=excel_row, column=COL_PRODUCT_URL, value=_cell_value(product_url))
+        self.pending += 1
+        if self.checkpoint_every and self.pending >= self.checkpoint_every:
+            self.flush()
+        return excel_row
+
+    @traced("excel_flush")
+    def flush(self):
+        """Serialize the open workbook into a new buffer and publish it as `excel_buffer`."""
+        global excel_buffer
         new_buffer = io.BytesIO()
-        wb.save(new_buffer)
-
+        self.wb.save(new_buffer)
         # Reset pointer so future reads start from the beginning
         new_buffer.seek(0)
-
-        # Update the global buffer
         excel_buffer = new_buffer
+        print(f"Checkpoint: {self.pending} pending row(s) written to the Excel buffer.")
+        self.pending = 0
+        return excel_buffer
 
-        print(f"Row {excel_row} updated in memory for product at index {row_index}.")
+def start_results_writer(checkpoint_every=0):
+    """
+    Opens the in-memory workbook once for the run. All save_data_to_file calls
+    go into this writer until flush_results_to_file() is called.
+    """
+    global results_writer
+    if excel_buffer is None:
+        st.error("Error: Excel buffer not initialized. Please upload a file first.")
+        return None
+    results_writer = ExcelResultsWriter(excel_buffer, checkpoint_every=checkpoint_every)
+    return results_writer
+
+@traced("excel_save")
+def save_data_to_file(row_index, discounted_price, original_price, product_thc, product_url, best_match="", score=None, journal=True):
+    """
+    Records scraped data for a specific row in the open results workbook.
+    The workbook itself is only re-serialized at checkpoints (see ExcelResultsWriter);
+    the row is also appended to the streaming results log right away.
+    journal=False keeps the row out of the run journal (blank rows of a failed
+    listing), so a resumed run retries it instead of skipping it.
+    """
+    if results_writer is None and start_results_writer() is None:
+        return
 
+    try:
+        excel_row = results_writer.write_row(row_index, discounted_price, original_price, product_thc, product_url)
+        print(f"Row {excel_row} updated in memory for product at index {row_index}.")
     except Exception as e:
         st.error(f"Error saving data to Excel for row {row_index}: {e}")
+        return
+
+    if run_journal is not None and journal:
+        try:
+            run_journal.record(row_index, discounted_price, original_price, product_thc, product_url)
+        except OSError as e:
+            print(f"Could not journal row {row_index}: {e}")
+
+    if results_stream is not None:
+        try:
+            results_stream.append(row_index, discounted_price, original_price, product_thc, product_url, best_match, score)
+        except (OSError, ValueError) as e:
+            print(f"Could not stream row {row_index}: {e}")
+
+def flush_results_to_file():
+    """
+    Writes every pending row back into `excel_buffer` in a single save.
+    """
+    if results_writer is None:
+        return excel_buffer
+    try:
+        return results_writer.flush()
+    except Exception as e:
+        st.error(f"Error writing results back to the Excel file: {e}")
+        return excel_buffer
+
+# ---------- Run journal (resumable runs) ----------
+# Local working directory for run state (snapshot cache, run journals, ...)
+CACHE_DIR = os.environ.get("SCRAPER_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".scraper_cache"))
+
+def run_id_for(file_bytes, category):
+    """A run is identified by the uploaded sheet's content and the selected category."""
+    return f"{hashlib.sha1(file_bytes).hexdigest()[:16]}-{slugify_brand_for_param(str(category)) or 'all'}"
+
+class RunJournal:
+    """
+    Append-only JSON-lines log of completed rows and their results, fsync'ed per
+    row so a crashed or restarted session can skip rows that are already done.
+    """
+
+    def __init__(self, run_id, directory=None):
+        directory = directory or os.path.join(CACHE_DIR, "runs")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{run_id}.jsonl")
+        self._file = None
+
+    def completed(self):
+        """{row_index: record} for every row recorded so far (a torn last line is ignored)."""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                done[record["row_index"]] = record
+        return done
+
+    def record(self, row_index, discounted_price, original_price, product_thc, product_url):
+        if self._file is None:
+            self._file = open(self.path, "a+", encoding="utf-8")
+            # a crash can leave a torn last line; start the next record on a fresh line
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != "\n":
+                    self._file.write("\n")
+        self._file.write(json.dumps({
+            "row_index": int(row_index),
+            "discounted": discounted_price,
+            "original": original_price,
+            "thc": product_thc,
+            "url": product_url,
+            "at": time.time(),
+        }) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def clear(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# Journal of the current run; None when resuming is switched off
+run_journal = None
+
+def resume_from_journal(journal):
+    """
+    Replays completed rows from the journal into the results workbook and
+    returns their row indices so the run can skip them.
+    """
+    completed = journal.completed()
+    for row_index, record in completed.items():
+        results_writer.write_row(row_index, record["discounted"], record["original"], record["thc"], record["url"])
+    return set(completed)
+
+# ---------- Streaming results log ----------
+RESULTS_STREAM_FIELDS = ["row_index", "product_name", "best_match", "score", "discounted", "original", "thc", "url", "at"]
+
+class ResultsStream:
+    """
+    Append-only CSV of finished rows (one line written and flushed per row), plus
+    an optional live st.dataframe the same rows are added to. Unlike the workbook
+    it can be downloaded or tailed while the run is still going.
+    """
+
+    def __init__(self, run_id, product_names=None, directory=None):
+        directory = directory or os.path.join(CACHE_DIR, "results")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{run_id}.csv")
+        self.product_names = product_names if product_names is not None else {}
+        self.rows = 0
+        self.table = None
+        self.downloads = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            # rows streamed by an earlier (resumed) run of the same sheet stay in the log
+            with open(self.path, encoding="utf-8") as f:
+                self.rows = max(0, sum(1 for _ in f) - 1)
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=RESULTS_STREAM_FIELDS)
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def attach_table(self, container):
+        """Shows rows as they are appended in an (initially empty) dataframe on `container`."""
+        self.table = container.dataframe(pd.DataFrame(columns=RESULTS_STREAM_FIELDS[:-1]), use_container_width=True)
+
+    def append(self, row_index, discounted_price, original_price, product_thc, product_url, best_match="", score=None):
+        record = {
+            "row_index": int(row_index),
+            "product_name": self.product_names.get(row_index, ""),
+            "best_match": best_match or "",
+            "score": "" if score is None else round(float(score), 3),
+            "discounted": _cell_value(discounted_price),
+            "original": _cell_value(original_price),
+            "thc": _cell_value(product_thc),
+            "url": _cell_value(product_url),
+            "at": round(time.time(), 3),
+        }
+        with self._lock:
+            self._writer.writerow(record)
+            self._file.flush()
+            self.rows += 1
+        if self.table is not None:
+            try:
+                self.table.add_rows(pd.DataFrame([record], columns=RESULTS_STREAM_FIELDS[:-1]))
+            except Exception as e:
+                print(f"Live results table not updated: {e}")
+
+    def read_bytes(self):
+        with self._lock:
+            self._file.flush()
+            with open(self.path, "rb") as f:
+                return f.read()
+
+    def clear(self):
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._writer.writeheader()
+            self._file.flush()
+            self.rows = 0
+
+    def close(self):
+        self._file.close()
+
+    def finish(self):
+        """
+        Closes the log of a completed run and moves it aside to <run_id>.completed.csv,
+        so the next run of the same sheet starts a fresh log instead of appending to it.
+        """
+        self.close()
+        completed_path = self.path[:-len(".csv")] + ".completed.csv"
+        os.replace(self.path, completed_path)
+        return completed_path
+
+# Results log of the current run; None outside a scrape
+results_stream = None
+
+# ---------- Resource blocking ----------
+# The menu's own hosts; their scripts, API calls (XHR/fetch), documents and styles
+# are never blocked. Subdomains count as first-party.
+FIRST_PARTY_HOSTS = ("terrabis.co", "dutchie.com")
+
+# URL patterns (CDP Network.setBlockedURLs syntax, '*' wildcard) per resource group:
+# third-party hosts, plus media/font file extensions (with or without a query
+# string), which a script, API call or stylesheet URL never ends in
+RESOURCE_BLOCKLISTS = {
+    "images": ["*imgix.net*"],
+    "media": ["*.mp4", "*.mp4?*", "*.webm", "*.webm?*", "*.m3u8", "*.m3u8?*", "*.mp3", "*.mp3?*",
+              "*.m4a", "*.m4a?*", "*.ogg", "*.ogg?*", "*.wav", "*.wav?*",
+              "*player.vimeo.com*", "*youtube.com/embed*", "*i.ytimg.com*"],
+    "fonts": ["*.woff", "*.woff?*", "*.woff2", "*.woff2?*", "*.ttf", "*.ttf?*", "*.otf", "*.otf?*", "*.eot", "*.eot?*",
+              "*fonts.googleapis.com*", "*fonts.gstatic.com*", "*use.typekit.net*"],
+    "analytics": [
+        "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googleadservices.com*",
+        "*connect.facebook.net*", "*facebook.com/tr*", "*hotjar.com*", "*clarity.ms*", "*segment.io*",
+        "*cdn.segment.com*", "*fullstory.com*", "*nr-data.net*", "*js-agent.newrelic.com*", "*bat.bing.com*",
+        "*analytics.tiktok.com*", "*sc-static.net*", "*ct.pinterest.com*", "*stats.wp.com*", "*quantserve.com*",
+    ],
+}
+
+# Request types a group also blocks on any host (Playwright's request.resource_type;
+# Selenium blocks images through a content setting instead)
+RESOURCE_TYPES = {
+    "images": {"image"},
+    "media": {"media"},
+    "fonts": {"font"},
+    "analytics": set(),
+}
+
+# Request types that are never blocked on a first-party host
+FIRST_PARTY_REQUIRED_TYPES = {"document", "script", "xhr", "fetch", "stylesheet", "websocket", "eventsource"}
+
+# Named profiles selectable in the sidebar
+RESOURCE_PROFILES = {
+    "off": [],
+    "trackers": ["analytics"],
+    "lean": ["media", "fonts", "analytics"],
+    "aggressive": ["images", "media", "fonts", "analytics"],
+}
+
+def is_first_party(url):
+    host = (urlsplit(url).hostname or "").lower()
+    return any(host == h or host.endswith("." + h) for h in FIRST_PARTY_HOSTS)
+
+def blocked_url_patterns(profile):
+    """
+    URL patterns blocked by a profile. A pattern naming a first-party host is
+    skipped, so the menu's own scripts, API calls and styles always load.
+    """
+    patterns = []
+    for group in RESOURCE_PROFILES.get(profile, []):
+        for pattern in RESOURCE_BLOCKLISTS[group]:
+            if any(host in pattern for host in FIRST_PARTY_HOSTS):
+                print(f"Resource blocking: '{pattern}' names a first-party host; skipped.")
+                continue
+            patterns.append(pattern)
+    return patterns
+
+def blocked_resource_types(profile):
+    """Request types (image, media, font) a profile blocks regardless of host."""
+    return set().union(*(RESOURCE_TYPES[group] for group in RESOURCE_PROFILES.get(profile, [])))
+
+def should_block_request(url, resource_type, patterns, blocked_types):
+    """
+    Decides one request (Playwright routing). First-party scripts, API calls and
+    documents always load; otherwise the request is blocked by type or host pattern.
+    """
+    first_party = is_first_party(url)
+    if first_party and resource_type in FIRST_PARTY_REQUIRED_TYPES:
+        return False
+    if resource_type in blocked_types:
+        return True
+    return not first_party and any(fnmatch.fnmatchcase(url, pattern) for pattern in patterns)
+
+# Set from the sidebar; applied to every driver get_driver() starts
+resource_block_profile = "lean"
+
+# ---------- Driver startup cache ----------
+# Probing Chrome's version, downloading + patching chromedriver and creating a
+# fresh profile are done once and reused by every get_driver() call.
+DRIVER_CACHE_DIR = os.path.join(CACHE_DIR, "driver")
+_startup_lock = threading.Lock()
+
+def chrome_startup_info():
+    """
+    (chrome binary, major version), remembered in startup.json until the binary
+    changes (path or mtime), so `chrome --version` is not spawned per driver.
+    """
+    chrome_bin = _find_chrome_binary()
+    if not chrome_bin:
+        return None, None
+    info_path = os.path.join(DRIVER_CACHE_DIR, "startup.json")
+    mtime = os.path.getmtime(chrome_bin)
+    with _startup_lock:
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            if info.get("chrome_bin") == chrome_bin and info.get("mtime") == mtime:
+                return chrome_bin, info["major"]
+        except (OSError, ValueError, KeyError):
+            pass
+        major = _chrome_major(chrome_bin)
+        os.makedirs(DRIVER_CACHE_DIR, exist_ok=True)
+        with open(info_path, "w") as f:
+            json.dump({"chrome_bin": chrome_bin, "mtime": mtime, "major": major}, f)
+        return chrome_bin, major
+
+def chromedriver_major(path):
+    """Major version reported by `chromedriver --version`, or None if it cannot be read."""
+    try:
+        out = subprocess.check_output([path, "--version"], timeout=20).decode()
+    except Exception:
+        return None
+    m = re.search(r"ChromeDriver\s+(\d+)\.", out)
+    return int(m.group(1)) if m else None
 
-def get_driver(headful: bool = False, proxy: str | None = None):
+def patched_chromedriver(major):
+    """
+    Path of a chromedriver already patched by undetected_chromedriver for this
+    Chrome major version. Passing it as driver_executable_path makes uc.Chrome
+    only verify the patch instead of deleting, re-downloading and re-patching.
+    """
+    path = os.path.join(DRIVER_CACHE_DIR, f"chromedriver-{major}")
+    with _startup_lock:
+        if os.path.exists(path) and uc.Patcher(executable_path=path, version_main=major).is_binary_patched(path) \
+                and chromedriver_major(path) == major:
+            return path
+        os.makedirs(DRIVER_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # a chromedriver installed next to Chromium (packages.txt) is patched in place: no download, works offline.
+        # It must match Chrome's major version; otherwise uc downloads the right one.
+        local_driver = os.environ.get("CHROMEDRIVER_PATH") or shutil.which("chromedriver")
+        if local_driver and chromedriver_major(local_driver) != major:
+            print(f"Local chromedriver {local_driver} (version {chromedriver_major(local_driver)}) "
+                  f"does not match Chrome {major}; downloading a matching one.")
+            local_driver = None
+        if local_driver:
+            shutil.copy2(local_driver, tmp_path)
+            uc.Patcher(executable_path=tmp_path, version_main=major).auto()
+        else:
+            patcher = uc.Patcher(version_main=major)
+            patcher.auto()
+            shutil.copy2(patcher.executable_path, tmp_path)
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, path)
+        print(f"Patched chromedriver {major} cached at {path}")
+        return path
+
+def profile_template(chrome_bin):
+    """
+    A user-data dir Chrome has already initialised (first-run files, Local State,
+    component data). Each driver starts from a copy instead of an empty profile.
+    """
+    template = os.path.join(DRIVER_CACHE_DIR, "profile-template")
+    with _startup_lock:
+        if os.path.isdir(template):
+            return template
+        os.makedirs(DRIVER_CACHE_DIR, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix="profile-template-", dir=DRIVER_CACHE_DIR)
+        subprocess.run(
+            [chrome_bin, "--headless=new", "--no-sandbox", "--disable-gpu", "--no-first-run",
+             f"--user-data-dir={staging}", "--dump-dom", "about:blank"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60, check=False
+        )
+        os.replace(staging, template)
+        print(f"Chrome profile template warmed at {template}")
+        return template
+
+def copy_profile_template(template):
+    """Private copy of the profile template for one driver (lock files left behind)."""
+    profile_dir = tempfile.mkdtemp(prefix="uc-profile-")
+    shutil.copytree(template, profile_dir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns("Singleton*", "*.lock", "lockfile"))
+    return profile_dir
+
+@traced("driver_start")
+def get_driver(headful: bool = False, proxy: str | None = None, block_profile: str | None = None):
     import undetected_chromedriver as uc
     from selenium.webdriver.support.ui import WebDriverWait
 
-    chrome_bin = _find_chrome_binary()
+    chrome_bin, major = chrome_startup_info()
     if not chrome_bin:
         raise FileNotFoundError("No Chrome/Chromium binary found. Install it or set UC_CHROME_BINARY.")
 
     os.environ["UC_CHROME_BINARY"] = chrome_bin
-    major = _chrome_major(chrome_bin)
+    block_profile = block_profile or resource_block_profile
+    blocked_groups = RESOURCE_PROFILES.get(block_profile, [])
 
     options = uc.ChromeOptions()
 
@@ -471,9 +1380,13 @@ def get_driver(headful: bool = False, proxy: str | None = None):
         options.add_argument("--hide-scrollbars")
 
     # --- prefs & page-load strategy ---
-    options.add_experimental_option("prefs", {
+    prefs = {
         "profile.default_content_setting_values.geolocation": 1
-    })
+    }
+    if "images" in blocked_groups:
+        # images never requested at all; layout boxes still render so tiles keep their structure
+        prefs["profile.managed_default_content_settings.images"] = 2
+    options.add_experimental_option("prefs", prefs)
     try:
         options.page_load_strategy = "eager"
     except Exception:
@@ -498,11 +1411,42 @@ def get_driver(headful: bool = False, proxy: str | None = None):
     if proxy:
         options.add_argument(f"--proxy-server={proxy}")
 
-    driver = uc.Chrome(
-        options=options,
-        version_main=major,
-        patcher_force_close=True
-    )
+    # Reuse the cached patched chromedriver and a copy of the warmed profile;
+    # without them uc falls back to downloading/patching and an empty temp profile
+    startup_kwargs = {}
+    profile_dir = None
+    try:
+        startup_kwargs["driver_executable_path"] = patched_chromedriver(major)
+        profile_dir = copy_profile_template(profile_template(chrome_bin))
+        startup_kwargs["user_data_dir"] = profile_dir
+    except Exception as e:
+        print(f"Driver startup cache unavailable ({e}); starting uncached.")
+
+    # uc.Chrome appends to the options it is given, so the fallback start gets a fresh copy
+    fallback_options = copy.deepcopy(options)
+    try:
+        driver = uc.Chrome(
+            options=options,
+            version_main=major,
+            patcher_force_close=True,
+            **startup_kwargs
+        )
+    except Exception as e:
+        if not startup_kwargs:
+            raise
+        # e.g. a cached driver that no longer fits this Chrome: let uc download/patch its own
+        print(f"Cached driver startup failed ({e}); starting uncached.")
+        if profile_dir:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            profile_dir = None
+        driver = uc.Chrome(
+            options=fallback_options,
+            version_main=major,
+            patcher_force_close=True,
+        )
+    if profile_dir:
+        # uc keeps a user-supplied profile; remove our copy once the driver is gone
+        weakref.finalize(driver, shutil.rmtree, profile_dir, True)
     wait = WebDriverWait(driver, 20)
 
     # Extra realism via CDP (timezone/locale/UA hints + geolocation)
@@ -525,6 +1469,18 @@ def get_driver(headful: bool = False, proxy: str | None = None):
     except Exception:
         pass
 
+    # Block third-party trackers/fonts by host (images are off via the content setting).
+    # The Dutchie iframe shares the page's process (site-per-process is disabled
+    # above), so the blocklist covers it as well; first-party hosts are never listed.
+    patterns = blocked_url_patterns(block_profile)
+    if patterns:
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+            print(f"Resource blocking '{block_profile}': {len(patterns)} pattern(s).")
+        except Exception as e:
+            print(f"Resource blocking unavailable: {e}")
+
     return driver, wait
 
     
@@ -669,16 +1625,22 @@ def clean_thc_value(thc_string):
         return match.group(1).strip()
     return thc_string # Return original if no match (e.g., if it's already just the value)
 
+@traced("age_gate")
 def handle_age_verification_popup(driver, wait):
     """
     Close the age verification / popup reliably in headless.
     """
     st.info("Waiting for pop-up to appear and attempting to close it...")
-    time.sleep(2)
+    started = time.time()
     try:
-        btn = wait_present(driver, (By.CSS_SELECTOR, "a.pum-close.elementor-element-ebd2f15"), timeout=15)
+        btn = adaptive_timeouts.wait(driver, "age_gate", EC.presence_of_element_located((By.CSS_SELECTOR, "a.pum-close.elementor-element-ebd2f15")), 15)
         stable_click(driver, btn)
-        time.sleep(1.0)
+        # the popup fades out; wait for the close button to go away instead of sleeping
+        try:
+            WebDriverWait(driver, 3).until(EC.invisibility_of_element(btn))
+        except TimeoutException:
+            pass
+        report_wait("Age gate closed", started)
         print("Pop-up closed successfully!")
     except Exception as e:
         print(f"Age-gate close not found or already closed: {e}")
@@ -708,6 +1670,7 @@ direct_category_links = {
     'Accessories': 'https://terrabis.co/order-online/grayville/?dtche%5Bsortby%5D=relevance&dtche%5Bcategory%5D=accessories'
 }
 
+@traced("category_navigation")
 def scrape_category(category, driver):
     website_url = 'https://terrabis.co/illinois/grayville/'
     
@@ -724,7 +1687,7 @@ def scrape_category(category, driver):
         handle_age_verification_popup(driver, wait)
         print(f"Successfully navigated to direct link for category '{category}'.")
         st.success(f"Category '{category}' selected via direct link.")
-        time.sleep(3) # Give some time for the new category page to load
+        wait_for_page_ready(driver, label="Category page ready")
         return True
 
     # If no direct link, proceed with carousel navigation logic
@@ -747,14 +1710,19 @@ def scrape_category(category, driver):
 
             # Try to find the category link in the current view
             category_link = wait_visible(driver, (By.XPATH, category_xpath))
+            start_url = driver.current_url
             if not stable_click(driver, category_link):
                 st.warning("Category click fallback retry...")
-                time.sleep(0.6)
                 category_link = wait_visible(driver, (By.XPATH, category_xpath))
                 stable_click(driver, category_link)
             print(f"Successfully selected category '{category}' on the website.")
             st.success(f"Category '{category}' found and selected.")
-            time.sleep(3) # Give some time for the new category page to load
+            # The click navigates to the category page; wait for the new URL, then for the page to settle
+            try:
+                WebDriverWait(driver, 10).until(EC.url_changes(start_url))
+            except TimeoutException:
+                pass
+            wait_for_page_ready(driver, label="Category page ready")
             category_found = True
             return True
 
@@ -776,17 +1744,23 @@ def scrape_category(category, driver):
                         return False
                     
                     # Ensure in view
-                    driver.execute_script("arguments[0].scrollIntoView({block:'center'});", next_button)
-                    time.sleep(0.2)
+                    driver.execute_script("arguments[0].scrollIntoView({block:'center', behavior:'instant'});", next_button)
                     # Track carousel movement
                     slick_track = wait_present(driver, (By.CSS_SELECTOR, ".slick-track"))
                     initial_transform = slick_track.get_attribute("style")
                     
                     stable_click(driver, next_button)
+                    started = time.time()
                     WebDriverWait(driver, 10).until(
                         lambda d: d.find_element(By.CSS_SELECTOR, ".slick-track").get_attribute("style") != initial_transform
                     )
-                    time.sleep(0.6)
+                    # let the slide transition finish before looking for the category again
+                    WebDriverWait(driver, 3, poll_frequency=0.1).until(
+                        lambda d: d.execute_script(
+                            "return document.querySelectorAll('.slick-track .slick-slide.slick-active').length > 0"
+                        )
+                    )
+                    report_wait("Carousel advanced", started)
                     
                     clicked_next_count += 1  # <-- add this line so the outer loop progresses
                     # next_button = wait.until(
@@ -818,13 +1792,12 @@ def scrape_category(category, driver):
                     # # This indicates the carousel has actually moved.
                     # wait.until(lambda d: d.find_element(By.CSS_SELECTOR, ".slick-track").get_attribute("style") != initial_transform)
                     
-                    time.sleep(2) # Additional brief pause after content update and carousel movement
                     break # Break from the retry loop if click was successful and content updated
                 
                 except (ElementClickInterceptedException, StaleElementReferenceException) as e:
                     print(f"Click interception/stale element on 'Next' button. Retrying (Attempt {attempt + 1}/{next_button_click_attempts}). Error: {e}")
                     st.warning(f"Next button click intercepted or stale. Retrying ({attempt + 1}/{next_button_click_attempts})...")
-                    time.sleep(2) # Wait before retrying the click
+                    time.sleep(0.5) # brief back-off before retrying the click
                     if attempt == next_button_click_attempts - 1:
                         print("Max retry attempts for 'Next' button reached. Carousel did not advance.")
                         st.error("Could not click 'Next' button or carousel did not advance after multiple attempts.")
@@ -869,49 +1842,57 @@ brand_mapping = {
 # Categories on the site that have no brand filter
 no_brand_categories = ['Apparel']
 
+def expand_brands_section(driver):
+    """Opens the filter panel's "Brands" section (if collapsed) and keeps it in view."""
+    try:
+        brand_section_button = driver.find_element(By.XPATH, "//button[contains(., 'Brands')]")
+        driver.execute_script("arguments[0].scrollIntoView({block:'center', behavior:'instant'});", brand_section_button)
+        if brand_section_button.get_attribute("aria-expanded") == "false":
+            stable_click(driver, brand_section_button)
+            started = time.time()
+            WebDriverWait(driver, 5, poll_frequency=0.1).until(
+                lambda d: brand_section_button.get_attribute("aria-expanded") != "false"
+            )
+            report_wait("Brands section expanded", started)
+        # Keep the section in view
+        driver.execute_script("arguments[0].scrollIntoView({block:'center', behavior:'instant'});", brand_section_button)
+    except Exception as e:
+        print(f"Could not expand 'Brands' section: {e}")
+
+@traced("brand_filter")
 def scrape_brand(brand, driver):
     """
     Selects a brand using a headless-safe approach:
     1) Expand "Brands" section
-    2) Try React-safe typing into the search box (dispatch events)
-    3) Fallback: click 'Show more' and scan/scroll labels
+    2) Expand and search the whole brand list in one script call (BrandFacetResolver)
+    3) Fallback: React-safe typing into the search box (dispatch events)
     """
     brand_name_on_website = brand_mapping.get(brand, brand)
     target_norm = " ".join(brand_name_on_website.lower().split())
 
+    category = getattr(driver, "current_category", None)
+
     # If category doesn't use brand filters, do the simple direct scan you had
-    if getattr(driver, "current_category", None) in ["TOPICAL", "ACCESSORIES"]:
-        labels = driver.find_elements(By.XPATH, "//label")
-        for lbl in labels:
-            label_text = " ".join(lbl.text.split()).lower()
-            if target_norm in label_text:
-                cb = driver.find_element(By.CSS_SELECTOR, f"input[id='{lbl.get_attribute('for')}']")
-                if not cb.is_selected():
-                    driver.execute_script("arguments[0].scrollIntoView({block:'center'});", lbl)
-                    time.sleep(0.2)
-                    stable_click(driver, lbl)
-                    print(f"✔ Selected brand (direct): {lbl.text}")
-                else:
-                    print(f"ℹ️ Already selected (direct): {lbl.text}")
-                return True
+    if category in ["TOPICAL", "ACCESSORIES"]:
+        if brand_facets.select(driver, category, brand_name_on_website):
+            print(f"✔ Selected brand (direct): {brand_name_on_website}")
+            return True
         st.error(f"⚠️ Brand not found (direct): {brand_name_on_website}")
         return False
 
     # Expand "Brands" filter
+    expand_brands_section(driver)
+
+    # One script call expands and searches the whole brand list (cached per category)
     try:
-        brand_section_button = driver.find_element(By.XPATH, "//button[contains(., 'Brands')]")
-        driver.execute_script("arguments[0].scrollIntoView({block:'center'});", brand_section_button)
-        time.sleep(0.5)
-        if brand_section_button.get_attribute("aria-expanded") == "false":
-            stable_click(driver, brand_section_button)
-            time.sleep(0.8)
-        # Keep the section in view
-        driver.execute_script("arguments[0].scrollIntoView({block:'center'});", brand_section_button)
-        time.sleep(0.3)
-    except Exception as e:
-        print(f"Could not expand 'Brands' section: {e}")
+        if brand_facets.select(driver, category, brand_name_on_website):
+            print(f"✔ Selected brand via facet list: {brand_name_on_website}")
+            wait_for_dom_quiet(driver, label="Brand filter applied")
+            return True
+    except WebDriverException as e:
+        print(f"Facet-list selection failed (falling back to search): {e}")
 
-    # Try search input first (React-safe)
+    # Fall back to the search input (React-safe)
     try:
         # Avoid hashed classes; use placeholder/role based selectors
         search_input = WebDriverWait(driver, 6).until(EC.presence_of_element_located((
@@ -922,15 +1903,12 @@ def scrape_brand(brand, driver):
         driver.execute_script("arguments[0].focus();", search_input)
         driver.execute_script("arguments[0].value='';", search_input)
         type_react_input(driver, search_input, brand_name_on_website)
-        time.sleep(1.0)  # let debounce/filtering run
 
-        # Wait for matching label to appear
+        # Wait for matching label to appear (covers the search debounce)
         label = WebDriverWait(driver, 6).until(EC.presence_of_element_located((
             By.XPATH,
             f"//label[contains(translate(normalize-space(.), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), '{target_norm}')]"
         )))
-        driver.execute_script("arguments[0].scrollIntoView({block:'center'});", label)
-        time.sleep(0.2)
         stable_click(driver, label)
 
         # Ensure checkbox toggled
@@ -943,27 +1921,14 @@ def scrape_brand(brand, driver):
             pass
 
         print(f"✔ Selected brand via search: {brand_name_on_website}")
-        time.sleep(1.0)
+        wait_for_dom_quiet(driver, label="Brand filter applied")
         return True
 
     except Exception as e:
-        print(f"Search-based selection failed (falling back): {e}")
+        print(f"Search-based selection failed: {e}")
 
-    # Fallbacks when search is unreliable in headless
-    click_show_more_until_exhausted(driver)
-    try:
-        ok = scroll_filter_panel_to_find_label(driver, brand_name_on_website, max_scrolls=40)
-        if ok:
-            print(f"✔ Selected brand via list scan: {brand_name_on_website}")
-            time.sleep(1.0)
-            return True
-        else:
-            st.error(f"⚠️ Brand not found: {brand_name_on_website}")
-            return False
-    except Exception as e:
-        print(f"Label-scan fallback failed: {e}")
-        st.error(f"⚠️ Could not select brand '{brand_name_on_website}'.")
-        return False
+    st.error(f"⚠️ Brand not found: {brand_name_on_website}")
+    return False
 
 
 def normalize_weight(weight, has_unit=False):
@@ -1013,10 +1978,12 @@ def grams_to_ounces(grams):
             # For any other case (like 0.7 or 0.12oz), return the decimal representation
             return f"{rounded_ounces}oz"
 
-def scrape_weight(weight, driver):
+def pick_weight_option(option_texts, weight):
     """
-    Selects the weight filter from the weight options.
-    This function clicks the weight option based on the provided weight value.
+    Index of the weight option to click for `weight` among the listing's option
+    labels, trying grams first (with and without a leading zero) and then the
+    ounce equivalent. Returns (index, label), or (None, weight) if nothing matches
+    (the ounce weight when there is one; "100mg" or "1/8oz" have no gram conversion).
     """
     # Normalize weight (e.g., from "0.75 GRAMS" or "1 GRAMS")
     weight_norm = normalize_weight(weight)
@@ -1025,44 +1992,51 @@ def scrape_weight(weight, driver):
     if weight_norm.startswith("0."):
         variants.append(weight_norm[1:])
 
-    try:
-        # Find all weight filter links
-        weight_links = driver.find_elements(By.CSS_SELECTOR, "a.weight__Anchor-sc-10b36p8-0.geHygR")
-
-        # Loop through each weight option
-        for link in weight_links:
-            link_text = link.text.strip().lower()
+    labels = [text.strip().lower() for text in option_texts]
+    # assume pure numbers are grams (e.g. "28" -> "28g")
+    labels = [t + 'g' if t.replace('.', '', 1).isdigit() else t for t in labels]
 
-            # assume pure numbers are grams (e.g. "28" -> "28g")
-            if link_text.replace('.', '', 1).isdigit():
-                link_text = link_text + 'g'
+    # an exact label wins, so ".5g" does not pick "3.5g" when "0.5g" is listed
+    for i, link_text in enumerate(labels):
+        if link_text.replace(" ", "") in variants:
+            return i, link_text
 
-            # try each of our variants (with and without leading zero)
-            for v in variants:
-                if v in link_text:
-                    stable_click(driver, link)
-                    print(f"✔ Selected weight: {link_text}")
-                    return True
+    for i, link_text in enumerate(labels):
+        # try each of our variants (with and without leading zero)
+        for v in variants:
+            if v in link_text:
+                return i, link_text
 
-        # If no matching weight found in grams, convert to ounces
-        print(f"⚠️ Weight '{weight}' not found in grams. Trying to convert to ounces...")
-
-        # Convert weight to ounces
+    # If no matching weight found in grams, convert to ounces
+    print(f"⚠️ Weight '{weight}' not found in grams. Trying to convert to ounces...")
+    try:
         weight_in_ounces = grams_to_ounces(float(weight.replace('g', '').strip()))
-        print(f"Converted weight: {weight_in_ounces}")
-
-        # Search for the ounce weight
-        for link in weight_links:
-            link_text = link.text.strip().lower()
-            if weight_in_ounces in link_text:
-                stable_click(driver, link)
-                print(f"✔ Selected weight in ounces: {link_text}")
-                return True
-
-        # If still not found
-        st.error(f"⚠️ Weight '{weight_in_ounces}' not found.")
-        print(f"⚠️ Weight '{weight_in_ounces}' not found.")
-        return False
+    except ValueError:
+        return None, weight
+    print(f"Converted weight: {weight_in_ounces}")
+    for i, link_text in enumerate(labels):
+        if weight_in_ounces in link_text:
+            return i, link_text
+    return None, weight_in_ounces
+
+@traced("weight_filter")
+def scrape_weight(weight, driver):
+    """
+    Selects the weight filter from the weight options.
+    This function clicks the weight option based on the provided weight value.
+    """
+    try:
+        # Find all weight filter links
+        weight_links = driver.find_elements(By.CSS_SELECTOR, "a.weight__Anchor-sc-10b36p8-0.geHygR")
+        index, label = pick_weight_option([link.text for link in weight_links], weight)
+        if index is None:
+            st.error(f"⚠️ Weight '{label}' not found.")
+            print(f"⚠️ Weight '{label}' not found.")
+            return False
+
+        stable_click(driver, weight_links[index])
+        print(f"✔ Selected weight: {label}")
+        return True
 
     except Exception as e:
         print(f"⚠️ Could not select weight '{weight}'. Error: {e}")
@@ -1101,22 +2075,116 @@ RATIO_RE = re.compile(
     re.VERBOSE | re.IGNORECASE
 )
 
+@lru_cache(maxsize=8)
+def _flavor_regex(flavors):
+    """
+    One alternation regex for a whole flavor list, longest flavors first
+    (e.g. "grapefruit" before "grape"), with word boundaries around each.
+    """
+    sorted_flavors = sorted(flavors, key=len, reverse=True)
+    return re.compile(r"\b(?:" + "|".join(re.escape(f) for f in sorted_flavors) + r")\b")
+
 def extract_flavors(text, flavor_list):
     """
     Extracts flavors from a given text based on a predefined list of flavors.
     Returns a list of unique flavors found.
     """
-    found_flavors = set()
-    text_lower = text.lower()
-    
-    # Sort flavors by length descending to match longer phrases first (e.g., "blue raspberry" before "blue")
-    sorted_flavors = sorted(flavor_list, key=len, reverse=True)
+    return list({m.group(0) for m in _flavor_regex(tuple(flavor_list)).finditer(text.lower())})
+
+# Weight tokens after unit collapsing, e.g. "3.5g", "100mg", "1oz"
+WEIGHT_TOKEN_RE = re.compile(r'^\d+(?:\.\d+)?(?:g|mg|oz)$')
+
+@dataclass(frozen=True)
+class NameFeatures:
+    """Everything the matcher needs from one product name, computed once."""
+    name: str
+    qty_num: float | None
+    qty_unit: str | None
+    weight_tokens: tuple        # collapsed weight tokens as written, e.g. ("3.5g",)
+    flavors: frozenset
+    base_tokens: tuple          # lowercased tokens minus weight/quantity/ratio parts, in name order
+    base_token_set: frozenset
+
+    def keyword_tokens(self, brand_tokens, category_tokens):
+        """
+        Keyword tokens used for scoring: base tokens without brand, category and
+        stop words. Flavors are kept; they contribute to the general score.
+        """
+        return [
+            t for t in self.base_tokens
+            if t not in brand_tokens
+            and t not in STOPWORDS
+            and t not in category_tokens
+            and not (t.endswith("s") and t[:-1] in category_tokens)
+        ]
+
+class ProductNameAnalyzer:
+    """
+    Tokenizes product names once and caches the resulting NameFeatures by string,
+    so Excel targets and site products are not re-parsed for every comparison.
+    """
+
+    def __init__(self, flavor_list, max_entries=50000):
+        self.flavor_list = tuple(flavor_list)
+        self.max_entries = max_entries
+        self._cache = {}
+
+    def _parts_of(self, regex, name):
+        """Collapsed lowercase tokens making up every `regex` match in the name."""
+        parts = set()
+        for m in regex.finditer(name):
+            for part_token in TOKEN_RE.findall(m.group(0).lower()):
+                parts.add(part_token.replace(" ", "").lower())
+        return parts
+
+    def analyze(self, name):
+        features = self._cache.get(name)
+        if features is not None:
+            return features
+
+        qty_num, qty_unit = extract_and_normalize_quantity(name)
+        quantity_parts = self._parts_of(QUANTITY_RE, name)
+        ratio_parts = self._parts_of(RATIO_RE, name)
+
+        # tokenize and collapse spaces in units (so "3.5 g" → "3.5g")
+        collapsed = [t.replace(" ", "") for t in TOKEN_RE.findall(name)]
+        weight_tokens = tuple(t for t in collapsed if WEIGHT_TOKEN_RE.match(t.lower()))
+        base_tokens = tuple(
+            t for t in (c.lower() for c in collapsed)
+            if not WEIGHT_TOKEN_RE.match(t) and t not in quantity_parts and t not in ratio_parts
+        )
 
-    for flavor in sorted_flavors:
-        # Use word boundaries to avoid partial matches (e.g., 'grape' in 'grapefruit')
-        if re.search(r'\b' + re.escape(flavor) + r'\b', text_lower):
-            found_flavors.add(flavor)
-    return list(found_flavors)
+        features = NameFeatures(
+            name=name,
+            qty_num=qty_num,
+            qty_unit=qty_unit,
+            weight_tokens=weight_tokens,
+            flavors=frozenset(extract_flavors(name, self.flavor_list)),
+            base_tokens=base_tokens,
+            base_token_set=frozenset(base_tokens),
+        )
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+        self._cache[name] = features
+        return features
+
+@lru_cache(maxsize=4096)
+def brand_token_set(brand):
+    """This row’s brand tokens (spaces collapsed, lowercase)."""
+    return frozenset(t.replace(" ", "").lower() for t in TOKEN_RE.findall(brand))
+
+@lru_cache(maxsize=64)
+def category_token_set(website_cat):
+    """Website category tokens, with their singular forms."""
+    category_tokens = set()
+    for tok in TOKEN_RE.findall(website_cat):
+        lc = tok.replace(" ", "").lower()
+        category_tokens.add(lc)
+        if lc.endswith("s"):
+            category_tokens.add(lc[:-1])
+    return frozenset(category_tokens)
+
+name_analyzer = ProductNameAnalyzer(FLAVOR_LIST)
 
 def word_match_score(a, b):
     """
@@ -1129,17 +2197,1609 @@ def word_match_score(a, b):
     matches = sum(1 for w in wa if w in wb)
     return matches / len(wa)
 
-# Custom CSS to style the app
-st.markdown("""
-    <style>
-        /* Center the title */
-        .title {
-            text-align: center;
-            color: #000000;
-            font-size: 32px;
-        }
+# ---------- Dutchie HTTP product source ----------
+# The Terrabis embed is backed by Dutchie's GraphQL API. Reading it directly skips
+# Chrome entirely; the Selenium path stays as the fallback.
+DUTCHIE_GRAPHQL_URL = os.environ.get("DUTCHIE_GRAPHQL_URL", "https://dutchie.com/graphql")
+DUTCHIE_EMBED_BASE = os.environ.get("DUTCHIE_EMBED_BASE", "https://dutchie.com/embedded-menu")
+DUTCHIE_DISPENSARY_SLUG = os.environ.get("DUTCHIE_DISPENSARY_SLUG", "terrabis-grayville")
+DUTCHIE_DISPENSARY_ID = os.environ.get("DUTCHIE_DISPENSARY_ID", "")
+# Persisted-query hash of the FilteredProducts operation used by the embedded menu
+DUTCHIE_FILTERED_PRODUCTS_HASH = os.environ.get("DUTCHIE_FILTERED_PRODUCTS_HASH", "")
+
+# Website category → Dutchie product type
+dutchie_type_map = {
+    "Edibles": "Edible",
+    "Flower": "Flower",
+    "Vaporizers": "Vaporizers",
+    "Concentrates": "Concentrate",
+    "Topicals": "Topicals",
+    "Pre-Rolls": "Pre-Rolls",
+    "Tinctures": "Tincture",
+    "Apparel": "Apparel",
+    "Accessories": "Accessories",
+}
 
-        /* Style the main page background */
+def listing_weight_options(normalized_weight, option_lists):
+    """
+    Index of each product's option for the listing's weight filter (None when
+    the product is not in the filtered listing). The weight filter is picked the
+    way scrape_weight does on the site's weight links (pick_weight_option over
+    every option label of the listing), so a "3.5g" listing is the 3.5g filter
+    when any product offers it and the 1/8oz one only otherwise. When no link
+    matches, the site's listing stays unfiltered and each product's first option is used.
+    """
+    labels = []
+    for options in option_lists:
+        for option in options:
+            if str(option).strip() not in labels:
+                labels.append(str(option).strip())
+    index, _ = pick_weight_option(labels, normalized_weight)
+    if index is None:
+        return [0 if options else None for options in option_lists]
+    return [next((i for i, option in enumerate(options) if str(option).strip() == labels[index]), None)
+            for options in option_lists]
+
+def product_page_url(cname):
+    """The product link as the embed's tiles carry it: <embed base>/<dispensary>/product/<cName>."""
+    return f"{DUTCHIE_EMBED_BASE}/{DUTCHIE_DISPENSARY_SLUG}/product/{cname}"
+
+def canonical_product_url(url):
+    """
+    Drops the query string, fragment and trailing slash from a product link so
+    tile hrefs, HTTP snapshots and cached snapshots all carry the same URL.
+    """
+    if not url or not url.strip():
+        return url
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme, parts.netloc, parts.path.rstrip("/"), "", ""))
+
+def _format_price(value):
+    return f"${float(value):.2f}"
+
+def _format_thc(thc_content):
+    """Formats Dutchie's THCContent ({range, unit}) like the tile potency text."""
+    if not thc_content or not thc_content.get("range"):
+        return " "
+    unit = "%" if str(thc_content.get("unit", "")).upper().startswith("PERCENT") else " mg"
+    values = [f"{v:g}{unit}" for v in thc_content["range"] if v is not None]
+    return " - ".join(values) if values else " "
+
+class DutchieHttpSource:
+    """
+    Reads the embedded menu's products over HTTP with one pooled session.
+    Each category is fetched once (all pages) and brand/weight filtering is done locally.
+    """
+
+    def __init__(self, dispensary_id, query_hash=DUTCHIE_FILTERED_PRODUCTS_HASH,
+                 graphql_url=DUTCHIE_GRAPHQL_URL, pool_size=8, timeout=20, per_page=100):
+        self.dispensary_id = dispensary_id
+        self.query_hash = query_hash
+        self.graphql_url = graphql_url
+        self.timeout = timeout
+        self.per_page = per_page
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                          "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "apollographql-client-name": "Marketplace (production)",
+        })
+        self._categories = {}
+        self._lock = threading.Lock()
+
+    def _fetch_page(self, product_type, page):
+        variables = {
+            "includeEnterpriseSpecials": False,
+            "productsFilter": {
+                "dispensaryId": self.dispensary_id,
+                "pricingType": "rec",
+                "Status": "Active",
+                "types": [product_type],
+                "useCache": False,
+                "isDefaultSort": True,
+                "sortBy": "popularSortIdx",
+                "sortDirection": 1,
+                "bypassOnlineThresholds": False,
+                "isKioskMenu": False,
+                "removeProductsBelowOptionThresholds": True,
+            },
+            "page": page,
+            "perPage": self.per_page,
+        }
+        params = {
+            "operationName": "FilteredProducts",
+            "variables": json.dumps(variables, separators=(",", ":")),
+            "extensions": json.dumps({"persistedQuery": {"version": 1, "sha256Hash": self.query_hash}}, separators=(",", ":")),
+        }
+        resp = self.session.get(self.graphql_url, params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        payload = resp.json()
+        if payload.get("errors"):
+            raise RuntimeError(f"Dutchie GraphQL error: {payload['errors'][0].get('message')}")
+        return payload["data"]["filteredProducts"]["products"]
+
+    def category_products(self, website_cat):
+        """All raw Dutchie products of one website category, fetched once per run."""
+        product_type = dutchie_type_map.get(website_cat, website_cat)
+        with self._lock:
+            if product_type in self._categories:
+                return self._categories[product_type]
+        products, page = [], 0
+        while True:
+            batch = self._fetch_page(product_type, page)
+            products.extend(batch)
+            if len(batch) < self.per_page:
+                break
+            page += 1
+        with self._lock:
+            self._categories[product_type] = products
+        print(f"HTTP: fetched {len(products)} '{product_type}' product(s) in {page + 1} page(s).")
+        return products
+
+    @traced("http_fetch")
+    def snapshot(self, group_key):
+        """
+        Product dicts (name, url, thc, original, discounted) for one
+        (category, brand, weight) group, shaped like scrape_product_tiles output.
+        """
+        website_cat, mapped_brand, normalized_weight = group_key
+        brand_norm = " ".join(mapped_brand.lower().split()) if mapped_brand else None
+        listed = [
+            product for product in self.category_products(website_cat)
+            if not brand_norm or " ".join(str(product.get("brandName") or "").lower().split()) == brand_norm
+        ]
+        if normalized_weight is None:
+            option_indices = [0] * len(listed)
+        else:
+            option_indices = listing_weight_options(normalized_weight, [product.get("Options") or [] for product in listed])
+        snapshot = []
+        for product, option_index in zip(listed, option_indices):
+            if option_index is None:
+                continue
+            prices = product.get("recPrices") or product.get("Prices") or []
+            specials = product.get("recSpecialPrices") or []
+            original_price, discounted_price = " ", " "
+            if option_index < len(prices) and prices[option_index] is not None:
+                original_price = _format_price(prices[option_index])
+                if option_index < len(specials) and specials[option_index] is not None \
+                        and float(specials[option_index]) < float(prices[option_index]):
+                    discounted_price = _format_price(specials[option_index])
+            snapshot.append({
+                "name": product.get("Name", ""),
+                "url": product_page_url(product.get("cName", "")),
+                "thc": _format_thc(product.get("THCContent")),
+                "original": original_price,
+                "discounted": discounted_price,
+            })
+        return snapshot
+
+# Set from the sidebar; None means every listing goes through the browser
+http_product_source = None
+
+# ---------- Full-catalog mode (one unfiltered listing per category) ----------
+# Every tile of the loaded listing with its brand and all weight options
+CATALOG_TILES_JS = """
+const text = (root, sel) => {
+    const el = root.querySelector(sel);
+    return el ? el.innerText.trim() : null;
+};
+return Array.from(document.querySelectorAll("div[data-testid='product-list-item']:not([data-warm-stale])")).map(tile => {
+    const link = tile.querySelector("a");
+    const options = Array.from(tile.querySelectorAll("button[data-testid='option-tile']")).map(option => {
+        const strike = text(option, "span.optionstyles__OriginalPrice-sc-vu6uvs-2");
+        const label = (option.innerText || "").split("\\n")[0].trim();
+        return strike !== null
+            ? {label: label, original: strike, discounted: text(option, "b")}
+            : {label: label, original: text(option, "b"), discounted: null};
+    });
+    return {
+        name: text(tile, "div.full-card__Name-sc-11z5u35-4"),
+        brand: text(tile, "[class*='full-card__Brand']"),
+        url: link ? link.href : null,
+        thc: text(tile, "div.full-card__Potency-sc-11z5u35-8 > div"),
+        options: options,
+    };
+});
+"""
+
+# Scrolls to the end of the listing (infinite scroll) and returns the tile count
+SCROLL_LISTING_JS = """
+window.scrollTo(0, document.body.scrollHeight);
+return document.querySelectorAll("div[data-testid='product-list-item']:not([data-warm-stale])").length;
+"""
+
+# Clicks the listing's "next page" control if there is an enabled one; tiles are
+# marked stale first so FRESH_TILES_JS can tell when the next page has rendered
+NEXT_PAGE_JS = """
+const next = Array.from(document.querySelectorAll("button, a")).find(el =>
+    /next/i.test(el.getAttribute("aria-label") || "") && !el.disabled && el.getAttribute("aria-disabled") !== "true");
+if (!next) return false;
+document.querySelectorAll("div[data-testid='product-list-item']").forEach(t => t.setAttribute('data-warm-stale', '1'));
+next.click();
+return true;
+"""
+
+def load_listing_pages(driver, max_pages=40, max_scrolls=30):
+    """
+    Yields the raw catalog tiles of every page of the open listing, scrolling
+    each page until no more tiles load before moving on to the next one.
+    """
+    for page in range(max_pages):
+        previous = -1
+        for _ in range(max_scrolls):
+            driver.execute_script(SCROLL_LISTING_JS)
+            count = wait_for_tiles_settled(driver, timeout=6, label="Catalog scroll")
+            if count == previous:
+                break
+            previous = count
+        yield driver.execute_script(CATALOG_TILES_JS) or []
+        if not driver.execute_script(NEXT_PAGE_JS):
+            return
+        try:
+            WebDriverWait(driver, 15, poll_frequency=0.2).until(lambda d: d.execute_script(FRESH_TILES_JS))
+        except TimeoutException:
+            print(f"Catalog page {page + 2} did not render; stopping here.")
+            return
+
+class FullCatalogSource:
+    """
+    Loads each website category's unfiltered listing once in the browser and
+    answers every (category, brand, weight) group from it in memory, instead
+    of one filtered page load per group.
+    """
+
+    def __init__(self):
+        self._catalogs = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @traced("catalog_load")
+    def category_products(self, driver, wait, website_cat):
+        """Every tile of the category (deduplicated by URL), or None if the listing did not open."""
+        with self._lock:
+            lock = self._locks.setdefault(website_cat, threading.Lock())
+        # other workers needing the same category wait for the one loading it
+        with lock:
+            if website_cat in self._catalogs:
+                return self._catalogs[website_cat]
+            st.info(f"Loading the full '{website_cat}' catalog (no brand filter).")
+            if not open_listing(driver, wait, website_cat, None, f"catalog {website_cat}"):
+                return None
+            tiles = {}
+            for page_tiles in load_listing_pages(driver):
+                for tile in page_tiles:
+                    if tile.get("name"):
+                        tiles.setdefault(tile.get("url") or tile["name"], tile)
+            self._catalogs[website_cat] = list(tiles.values())
+            print(f"Catalog '{website_cat}': {len(tiles)} product tile(s).")
+            return self._catalogs[website_cat]
+
+    def snapshot(self, driver, wait, group_key):
+        """
+        Product dicts for one group, shaped like scrape_product_tiles output, or
+        None if the category listing could not be loaded or cannot answer the
+        brand (no tile carried a brand, or none carried this one), so the caller
+        falls back to the filtered listing.
+        """
+        website_cat, mapped_brand, normalized_weight = group_key
+        catalog = self.category_products(driver, wait, website_cat)
+        if catalog is None:
+            return None
+        brand_norm = " ".join(mapped_brand.lower().split()) if mapped_brand else None
+        if brand_norm:
+            catalog_brands = {" ".join(str(tile.get("brand") or "").lower().split()) for tile in catalog} - {""}
+            if not catalog_brands:
+                print(f"Catalog '{website_cat}' tiles carry no brand names; using the filtered listing.")
+                return None
+            if brand_norm not in catalog_brands:
+                print(f"Brand '{mapped_brand}' not among the '{website_cat}' catalog's brands; using the filtered listing.")
+                return None
+        listed = [
+            tile for tile in catalog
+            if not brand_norm or " ".join(str(tile.get("brand") or "").lower().split()) == brand_norm
+        ]
+        if normalized_weight is not None:
+            option_indices = listing_weight_options(
+                normalized_weight, [[opt["label"] for opt in tile.get("options") or []] for tile in listed]
+            )
+        raw = []
+        for position, tile in enumerate(listed):
+            options = tile.get("options") or []
+            option = options[0] if options else None
+            if normalized_weight is not None:
+                if option_indices[position] is None:
+                    continue
+                option = options[option_indices[position]]
+            raw.append({
+                "name": tile["name"],
+                "url": tile.get("url"),
+                "thc": tile.get("thc"),
+                "original": option and option.get("original"),
+                "discounted": option and option.get("discounted"),
+                "has_price": option is not None,
+            })
+        return normalize_tiles(raw)
+
+# Set from the sidebar; None means each group loads its own filtered listing
+full_catalog_source = None
+
+# ---------- Brand resolution index ----------
+# Words that brand spellings add or drop without naming a different brand
+BRAND_NOISE_WORDS = {"the", "inc", "llc", "co", "company"}
+BRAND_FUZZY_CUTOFF = 0.85
+BRAND_RESOLUTIONS_PATH = os.path.join(CACHE_DIR, "brand_resolutions.json")
+
+def normalize_brand_name(name):
+    """Lower-case alphanumeric words, '&' as 'and', noise words dropped."""
+    words = re.sub(r"[^a-z0-9]+", " ", str(name).lower().replace("&", " and ")).split()
+    kept = [w for w in words if w not in BRAND_NOISE_WORDS]
+    return " ".join(kept or words)
+
+class BrandIndex:
+    """
+    The brands one website category actually offers (its facet values), looked
+    up by exact URL slug, by normalized name, and by fuzzy alias (difflib) for
+    near-miss spellings in the sheet.
+    """
+
+    def __init__(self, names):
+        self.by_slug, self.by_normalized = {}, {}
+        for name in names:
+            if not name:
+                continue
+            self.by_slug.setdefault(slugify_brand_for_param(name), name)
+            self.by_normalized.setdefault(normalize_brand_name(name), name)
+
+    def __len__(self):
+        return len(self.by_slug)
+
+    def resolve(self, brand_name):
+        """(site brand name, how it was found) or (None, "unresolved")."""
+        name = self.by_slug.get(slugify_brand_for_param(brand_name))
+        if name:
+            return name, "slug"
+        normalized = normalize_brand_name(brand_name)
+        name = self.by_normalized.get(normalized)
+        if name:
+            return name, "normalized"
+        close = difflib.get_close_matches(normalized, list(self.by_normalized), n=1, cutoff=BRAND_FUZZY_CUTOFF)
+        if close:
+            return self.by_normalized[close[0]], "fuzzy"
+        return None, "unresolved"
+
+def brand_facet_names(driver, wait, website_cat):
+    """
+    The category's brand facet values and whether the list is complete: from the
+    HTTP catalog when that source is on (every page fetched), otherwise read off
+    the unfiltered listing's brand panel. (None, False) when no list could be read.
+    """
+    if http_product_source is not None:
+        try:
+            return {p.get("brandName") for p in http_product_source.category_products(website_cat)}, True
+        except Exception as e:
+            print(f"HTTP brand list for '{website_cat}' unavailable: {e}")
+    if driver is None:
+        return None, False
+    if not open_listing(driver, wait, website_cat, None, f"brands {website_cat}"):
+        return None, False
+    expand_brands_section(driver)
+    labels, complete = brand_facets.labels(driver, website_cat)
+    return set(labels), complete
+
+# (website category, mapped brand) → brand name as the site lists it; None = not offered.
+# None entries only ever come from this run's complete brand lists; they are never saved.
+brand_resolutions = {}
+
+def load_brand_resolutions(path=BRAND_RESOLUTIONS_PATH):
+    """
+    Brand names resolved by earlier runs, so offline re-matching uses the same
+    listing keys. Only positive resolutions are kept: a brand missing then may be listed now.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {(cat, brand): site for cat, brand, site in json.load(f) if site}
+    except (OSError, ValueError):
+        return {}
+
+# (website category, site brand name) this run's brand lists confirmed as offered;
+# only for these is an empty brand-filtered listing taken at face value
+brands_confirmed = set()
+
+def brand_confirmed(website_cat, brand_name):
+    """True when this run's brand list for the category lists the brand (by its site name)."""
+    return (website_cat, brand_name) in brands_confirmed
+
+def listing_is_empty(driver):
+    """True when the open listing shows the empty state instead of product tiles."""
+    try:
+        return bool(driver.execute_script(EMPTY_LISTING_JS))
+    except WebDriverException:
+        return False
+
+def brand_unresolved(group_key):
+    """True when this run's complete brand list for the category does not offer the group's brand."""
+    website_cat, mapped_brand, _ = group_key
+    return mapped_brand is not None and (website_cat, mapped_brand) in brand_resolutions \
+        and brand_resolutions[(website_cat, mapped_brand)] is None
+
+def save_brand_resolutions(resolutions, path=BRAND_RESOLUTIONS_PATH):
+    """Saves the positive resolutions (site brand names); "not offered" is never persisted."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([[cat, brand, site] for (cat, brand), site in resolutions.items() if site], f)
+
+@traced("brand_index")
+def resolve_sheet_brands(driver, wait, data):
+    """
+    Builds one BrandIndex per website category in `data` and resolves every
+    mapped brand against it. Returns a report DataFrame (one row per brand);
+    the resolutions are stored in `brand_resolutions` and on disk.
+    """
+    report_columns = ["Category", "Brand", "On site", "Resolved by"]
+    if driver is None and http_product_source is None:
+        st.info("Brand lists need a browser or the HTTP source; brands are used as mapped.")
+        return pd.DataFrame(columns=report_columns)
+
+    wanted = {}
+    for _, row in data.iterrows():
+        website_cat, brand, mapped_brand, _ = row_scrape_context(row, resolve=False)
+        if website_cat not in no_brand_categories:
+            wanted.setdefault(website_cat, {}).setdefault(mapped_brand, brand)
+
+    report = []
+    for website_cat, brands in wanted.items():
+        names, complete = brand_facet_names(driver, wait, website_cat)
+        if not names:
+            st.warning(f"Could not read the brand list of '{website_cat}'; its brands are used as mapped.")
+            continue
+        index = BrandIndex(names)
+        print(f"Brand index '{website_cat}': {len(index)} brand(s){'' if complete else ' (partial list)'}.")
+        for mapped_brand, brand in brands.items():
+            site_name, how = index.resolve(mapped_brand)
+            if site_name is None and not complete:
+                # a partial or timed-out read proves nothing: scrape the brand as mapped
+                how = "not verified"
+            else:
+                brand_resolutions[(website_cat, mapped_brand)] = site_name
+                if site_name:
+                    brands_confirmed.add((website_cat, site_name))
+            report.append({"Category": website_cat, "Brand": brand, "On site": site_name or "", "Resolved by": how})
+    save_brand_resolutions({**load_brand_resolutions(), **brand_resolutions})
+    return pd.DataFrame(report, columns=report_columns)
+
+# ---------- Brand/category groups and product snapshots ----------
+def row_scrape_context(row, resolve=True):
+    """
+    Resolves the website category, mapped brand and normalized weight for an Excel row.
+    With `resolve`, a brand found in the site's brand index is replaced by the
+    name the site uses for it.
+    """
+    brand = str(row['Brand'])
+    website_cat = category_mapping.get(row['Category'], row['Category'])
+    mapped_brand = brand_mapping.get(brand, brand)
+    if resolve and brand_resolutions.get((website_cat, mapped_brand)):
+        mapped_brand = brand_resolutions[(website_cat, mapped_brand)]
+    normalized_weight = normalize_weight(row['Weight'])
+    return website_cat, brand, mapped_brand, normalized_weight
+
+def group_key_for_row(row):
+    """
+    Rows that share (website category, mapped brand, weight) see exactly the same
+    filtered listing, so they can be matched against a single scraped snapshot.
+    Brand/weight are left out of the key when the category has no such filter.
+    """
+    website_cat, _, mapped_brand, normalized_weight = row_scrape_context(row)
+    brand_part = None if website_cat in no_brand_categories else mapped_brand
+    weight_part = None if website_cat in no_weight_categories else normalized_weight
+    return (website_cat, brand_part, weight_part)
+
+def plan_scrape_groups(data, by_listing=False):
+    """
+    Groups the Excel rows by listing. Returns {group_key: [row_index, ...]},
+    with groups and rows kept in sheet order, or with `by_listing` the groups
+    ordered by website category, then brand, then weight, so consecutive
+    listings differ by as little as possible (one filter switch in a warm session).
+    """
+    groups = {}
+    for row_index, row in data.iterrows():
+        groups.setdefault(group_key_for_row(row), []).append(row_index)
+    if by_listing:
+        groups = dict(sorted(groups.items(), key=lambda item: tuple(part or "" for part in item[0])))
+    return groups
+
+# Reads every product tile in one round trip; missing fields come back as null.
+# Tiles of the previous listing (marked data-warm-stale by in-app navigation) are skipped.
+EXTRACT_TILES_JS = """
+const text = (root, sel) => {
+    const el = root.querySelector(sel);
+    return el ? el.innerText.trim() : null;
+};
+return Array.from(document.querySelectorAll("div[data-testid='product-list-item']:not([data-warm-stale])")).map(tile => {
+    const link = tile.querySelector("a");
+    const option = tile.querySelector("button[data-testid='option-tile']");
+    let original = null, discounted = null;
+    if (option) {
+        const strike = text(option, "span.optionstyles__OriginalPrice-sc-vu6uvs-2");
+        if (strike !== null) {
+            // A struck-through original price means the <b> holds the discounted price
+            original = strike;
+            discounted = text(option, "b");
+        } else {
+            original = text(option, "b");
+        }
+    }
+    return {
+        name: text(tile, "div.full-card__Name-sc-11z5u35-4"),
+        url: link ? link.href : null,
+        thc: text(tile, "div.full-card__Potency-sc-11z5u35-8 > div"),
+        original: original,
+        discounted: discounted,
+        has_price: !!option,
+    };
+});
+"""
+
+def normalize_tiles(raw_tiles):
+    """
+    Turns the raw EXTRACT_TILES_JS result into product dicts
+    (name, url, thc, original, discounted), skipping tiles without a name.
+    """
+    products = []
+    for tile in raw_tiles or []:
+        name = tile.get("name")
+        if not name:
+            continue # tile without a name is still hydrating or is not a product card
+        if not tile.get("url"):
+            print(f"⚠️ URL not found for product '{name}'")
+        if not tile.get("has_price"):
+            print(f"⚠️ Price information not found for product '{name}'")
+        products.append({
+            "name": name,
+            "url": canonical_product_url(tile.get("url")) or " ",
+            "thc": clean_thc_value(tile["thc"]) if tile.get("thc") else " ",
+            "original": tile.get("original") or " ",
+            "discounted": tile.get("discounted") or " ",
+        })
+    return products
+
+@traced("extract")
+def scrape_product_tiles(driver):
+    """
+    Reads every product tile on the current listing into plain dicts
+    (name, url, thc, original, discounted) with a single execute_script call.
+    """
+    return normalize_tiles(driver.execute_script(EXTRACT_TILES_JS))
+
+def http_snapshot(group_key):
+    """
+    Listing fetched straight from the Dutchie API when the HTTP source is on.
+    Returns None when it is off or the request failed, so the caller falls back to a browser.
+    """
+    if http_product_source is None:
+        return None
+    try:
+        products = http_product_source.snapshot(group_key)
+        print(f"HTTP snapshot for {group_key}: {len(products)} product(s).")
+        return products
+    except Exception as e:
+        print(f"HTTP product source failed for {group_key}, falling back to the browser: {e}")
+        return None
+
+def acquire_product_snapshot(driver, wait, group_key, brand, category_url, row_index):
+    """
+    Opens the listing for one (category, brand, weight) group, applies the
+    filters and reads every product tile once.
+    Returns the list of product dicts ([] when nothing is listed), or None when
+    the brand filter could not be applied.
+    """
+    website_cat, mapped_brand, normalized_weight = group_key
+
+    products = http_snapshot(group_key)
+    if products is not None:
+        return products
+
+    if full_catalog_source is not None:
+        products = full_catalog_source.snapshot(driver, wait, group_key)
+        if products is not None:
+            print(f"Catalog snapshot for {group_key}: {len(products)} product(s).")
+            return products
+        st.warning(f"Full catalog for '{website_cat}' unavailable; loading the filtered listing instead.")
+
+    if mapped_brand is None:
+        # no brand facet on site: still open category page and switch into iframe
+        st.info(f"Opening category via URL: {website_cat} (no brand facet).")
+        brand_successfully_selected = open_listing(
+            driver, wait, website_cat,
+            None,          # no brand param
+            row_index
+        )
+    else:
+        # use URL-driven brand filter first
+        st.info(f"Applying brand via URL: {mapped_brand} in {website_cat}")
+        brand_successfully_selected = open_listing(
+            driver, wait, website_cat,
+            mapped_brand,  # mapped name → slug
+            row_index
+        )
+
+        # a wrong brand slug renders the same empty state as a brand with nothing listed;
+        # trust it only for brands this run's brand list confirmed
+        if brand_successfully_selected and listing_is_empty(driver) and not brand_confirmed(website_cat, mapped_brand):
+            st.warning(f"Brand URL filter for '{mapped_brand}' shows no products; checking with the UI brand filter.")
+            brand_successfully_selected = False
+
+        # optional UI fallback if URL approach failed
+        if not brand_successfully_selected:
+            st.warning("URL brand filter failed; trying UI brand filter.")
+            get_warm_session(driver).reset()
+            driver.switch_to.default_content()
+            # whole-sheet runs have no single category page; open this listing's category unfiltered
+            driver.get(category_url or build_terrabis_url("grayville", website_cat, None))
+            brand_successfully_selected = scrape_brand(brand, driver)
+
+    if not brand_successfully_selected:
+        st.error(f"⚠️ Brand '{brand}' not found")
+        return None
+
+    # --- WEIGHT SELECTION (CONDITIONAL) ---
+    if normalized_weight is None:
+        print(f"⏭ Skipping weight selection for category '{website_cat}' (no weight filter on site).")
+    else:
+        print(f"Selecting weight: {normalized_weight}")
+        scrape_weight(normalized_weight, driver)
+
+    try:
+        # wait for the product tiles to appear; an empty listing is recognised as soon as it renders
+        if adaptive_timeouts.wait(driver, "product_list", listing_tiles_or_empty, 8) == "empty":
+            st.warning(f"⚠️ No products found for brand **{brand}** in category **{website_cat}**")
+            return []
+        wait_for_tiles_settled(driver)  # tile count stable and prices hydrated
+        products = scrape_product_tiles(driver)
+        print(f"Snapshot for {group_key}: {len(products)} product tile(s).")
+        return products
+    except TimeoutException:
+        st.warning(f"⚠️ No products found for brand **{brand}** in category **{website_cat}**")
+        return []
+    except Exception as e:
+        st.error(f"An error occurred while scraping product tiles: {e}")
+        return []
+
+# ---------- Product snapshot cache ----------
+def snapshot_cache_key(group_key, city_slug="grayville"):
+    """
+    The filtered Terrabis URL (city, category slug, brand slug) plus the weight
+    filter identifies a listing deterministically.
+    """
+    website_cat, mapped_brand, normalized_weight = group_key
+    url = build_terrabis_url(city_slug, website_cat, mapped_brand)
+    return f"{url}#weight={normalized_weight}" if normalized_weight else url
+
+class SnapshotCache:
+    """
+    On-disk (SQLite) store of scraped product snapshots keyed by snapshot_cache_key.
+    Entries older than `ttl_seconds` are treated as misses; beyond `max_entries`
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=None, ttl_seconds=6 * 3600, max_entries=2000):
+        path = path or os.path.join(CACHE_DIR, "snapshots.sqlite3")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            " key TEXT PRIMARY KEY, products TEXT NOT NULL,"
+            " fetched_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key):
+        """Cached product list for `key`, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT products, fetched_at FROM snapshots WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE snapshots SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def load(self, key):
+        """Stored product list for `key` regardless of age (offline re-matching), or None."""
+        with self._lock:
+            row = self._db.execute("SELECT products FROM snapshots WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, products):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (key, products, fetched_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(products), now, now)
+            )
+            # LRU eviction beyond the size limit
+            self._db.execute(
+                "DELETE FROM snapshots WHERE key NOT IN "
+                "(SELECT key FROM snapshots ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+# Set from the sidebar; None disables caching
+snapshot_cache = None
+force_refresh_snapshots = False
+
+def cached_snapshot(group_key):
+    """Cached product list for the listing, or None (cache off, miss, expired or forced refresh)."""
+    if snapshot_cache is None:
+        return None
+    if force_refresh_snapshots:
+        snapshot_cache.misses += 1
+        return None
+    with stage_tracer.stage("cache_lookup"):
+        cached = snapshot_cache.get(snapshot_cache_key(group_key))
+    if cached is not None:
+        print(f"Cache hit for {group_key}: {len(cached)} product(s).")
+        # snapshots stored before URLs were canonicalised may still carry query strings
+        for product in cached:
+            product["url"] = canonical_product_url(product.get("url")) or " "
+    return cached
+
+def store_snapshot(group_key, products):
+    """Stores a freshly scraped, non-empty snapshot in the cache (if enabled)."""
+    if snapshot_cache is not None and products:
+        snapshot_cache.put(snapshot_cache_key(group_key), products)
+
+def get_product_snapshot(driver, wait, group_key, brand, category_url, row_index):
+    """
+    Cache-aware wrapper around acquire_product_snapshot. Fresh non-empty
+    snapshots are stored; a cache hit skips the network entirely.
+    """
+    stage_tracer.set_context(listing=" / ".join(str(part) for part in group_key if part))
+    cached = cached_snapshot(group_key)
+    if cached is not None:
+        return cached
+
+    products = acquire_product_snapshot(driver, wait, group_key, brand, category_url, row_index)
+    store_snapshot(group_key, products)
+    return products
+
+def scrape_groups_sequentially(managed, scrape_groups, data, category_url):
+    """
+    Yields (group_key, products) for every listing, one after another on a single managed driver.
+    """
+    for group_key, row_indices in scrape_groups.items():
+        first_row = data.loc[row_indices[0]]
+        yield group_key, managed.snapshot(group_key, str(first_row['Brand']), category_url, row_indices[0], first_row['Category'])
+
+# ---------- Parallel scraping (pool of independent drivers) ----------
+# Rough resident size of one headless Chrome with the Dutchie embed loaded
+CHROME_INSTANCE_MB = 600
+
+# uc.Chrome patches the shared chromedriver binary on start; only one driver boots at a time
+_driver_start_lock = threading.Lock()
+
+def max_parallel_drivers():
+    """
+    Upper bound for the worker pool: one driver per CPU core, limited by available RAM.
+    """
+    cpus = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        available_mb = int(meminfo["MemAvailable"].split()[0]) // 1024
+        by_memory = available_mb // CHROME_INSTANCE_MB
+    except Exception:
+        by_memory = cpus
+    return max(1, min(cpus, by_memory))
+
+# ---------- Managed drivers (health checks + recycling) ----------
+# Set from the sidebar; a driver is replaced after this many listings or above this JS heap size
+driver_recycle_pages = 40
+driver_recycle_heap_mb = 512
+
+# usedJSHeapSize is only precise because get_driver() passes --enable-precise-memory-info
+HEAP_USAGE_JS = "return (window.performance && performance.memory) ? performance.memory.usedJSHeapSize : null;"
+
+class ManagedDriver:
+    """
+    Owns one get_driver() instance for a worker. Before every listing the driver
+    is health-checked (responds to execute_script, JS heap below the limit) and
+    replaced when it is unhealthy or has served `max_pages` listings. A listing
+    that fails on a dead or wedged driver is retried once on a fresh one.
+    """
+
+    def __init__(self, category, driver=None, wait=None, max_pages=None, max_heap_mb=None, name="driver"):
+        self.category = category
+        self.driver, self.wait = driver, wait
+        self.max_pages = max_pages if max_pages is not None else driver_recycle_pages
+        self.max_heap_mb = max_heap_mb if max_heap_mb is not None else driver_recycle_heap_mb
+        self.name = name
+        self.pages = 0
+        self.recycles = 0
+        if driver is not None:
+            driver.current_category = category
+
+    def start(self):
+        with _driver_start_lock:
+            self.driver, self.wait = get_driver()
+        self.driver.current_category = self.category
+        self.pages = 0
+
+    def quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+        self.driver, self.wait = None, None
+
+    def recycle(self, reason):
+        print(f"♻ {self.name}: recycling browser after {self.pages} listing(s) ({reason}).")
+        self.recycles += 1
+        self.quit()
+        self.start()
+
+    def health(self):
+        """None when the driver is healthy, otherwise the reason it should be replaced."""
+        if self.driver is None:
+            return "not started"
+        try:
+            heap = self.driver.execute_script(HEAP_USAGE_JS)
+        except WebDriverException as e:
+            return f"unresponsive: {e.__class__.__name__}"
+        if heap and self.max_heap_mb and heap / (1024 * 1024) > self.max_heap_mb:
+            return f"JS heap {heap / (1024 * 1024):.0f} MB"
+        return None
+
+    def ensure_healthy(self):
+        if self.driver is None:
+            self.start()
+            return
+        if self.max_pages and self.pages >= self.max_pages:
+            self.recycle(f"{self.pages} listings served")
+            return
+        reason = self.health()
+        if reason:
+            self.recycle(reason)
+
+    def snapshot(self, group_key, brand, category_url, row_index, category=None):
+        """get_product_snapshot on a healthy driver, retried once on a fresh driver if it fails."""
+        if category is not None:
+            # whole-sheet runs move between (sheet) categories listing by listing
+            self.category = category
+        for attempt in (1, 2):
+            self.ensure_healthy()
+            self.driver.current_category = self.category
+            self.pages += 1
+            try:
+                products = get_product_snapshot(self.driver, self.wait, group_key, brand, category_url, row_index)
+            except Exception as e:
+                if attempt == 2:
+                    raise
+                self.recycle(f"listing failed: {e.__class__.__name__}")
+                continue
+            if products is None and attempt == 1:
+                # a brand filter that "failed" on a wedged browser deserves a second chance
+                reason = self.health()
+                if reason:
+                    self.recycle(reason)
+                    continue
+            return products
+
+def _scrape_worker(worker_id, jobs, results, category, category_url, driver=None, wait=None):
+    """
+    Pulls listings off the job queue and scrapes them on this worker's own managed driver.
+    Every finished listing is put on the results queue as (group_key, products);
+    a final (None, worker_id) marks the worker as done.
+    """
+    managed = ManagedDriver(category, driver, wait, name=f"Worker {worker_id}")
+    try:
+        if managed.driver is None:
+            managed.start()
+        print(f"Worker {worker_id}: driver ready.")
+
+        while True:
+            try:
+                group_key, brand, row_index, row_category = jobs.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                products = managed.snapshot(group_key, brand, category_url, row_index, row_category)
+            except Exception as e:
+                st.error(f"Worker {worker_id}: scraping {group_key} failed: {e}")
+                products = None
+            results.put((group_key, products))
+    except Exception as e:
+        st.error(f"Worker {worker_id} could not start a browser: {e}")
+    finally:
+        managed.quit()
+        results.put((None, worker_id))
+
+def scrape_groups_in_parallel(scrape_groups, data, category, category_url, workers, driver=None, wait=None):
+    """
+    Shards the listings across `workers` independent drivers and yields
+    (group_key, products) in the same order as `scrape_groups`, so rows are
+    still matched and written in sheet order. An already running driver can be
+    handed in to serve as the first worker.
+    """
+    jobs = queue.Queue()
+    for group_key, row_indices in scrape_groups.items():
+        first_row = data.loc[row_indices[0]]
+        jobs.put((group_key, str(first_row['Brand']), row_indices[0], first_row['Category']))
+
+    results = queue.Queue()
+    ctx = get_script_run_ctx()
+    workers = max(1, min(workers, len(scrape_groups)))
+    threads = []
+    for worker_id in range(workers):
+        args = (worker_id, jobs, results, category, category_url)
+        if worker_id == 0 and driver is not None:
+            args += (driver, wait)
+        t = threading.Thread(target=_scrape_worker, args=args, daemon=True)
+        add_script_run_ctx(t, ctx)
+        t.start()
+        threads.append(t)
+
+    yield from yield_in_plan_order(list(scrape_groups), results, len(threads))
+
+    for t in threads:
+        t.join()
+
+def yield_in_plan_order(order, results, running):
+    """
+    Re-orders listings finished out of order back into plan order.
+    `results` receives (group_key, products) from `running` producers, each of
+    which puts a final (None, producer_id) when done; listings no producer
+    delivered are yielded with None.
+    """
+    finished = {}
+    next_pos = 0
+    while next_pos < len(order):
+        if order[next_pos] in finished:
+            group_key = order[next_pos]
+            yield group_key, finished.pop(group_key)
+            next_pos += 1
+            continue
+        if running == 0:
+            # every worker exited; whatever is left was never scraped
+            group_key = order[next_pos]
+            yield group_key, None
+            next_pos += 1
+            continue
+        group_key, products = results.get()
+        if group_key is None:
+            running -= 1
+        else:
+            finished[group_key] = products
+
+# ---------- Async engine (Playwright) ----------
+# One browser process, one short-lived context per listing; the page scripts
+# written for Selenium are reused as Playwright evaluate() functions.
+DOM_QUIET_ASYNC_JS = (
+    "args => new Promise(resolve => (function () {" + DOM_QUIET_JS + "}).apply(null, [args[0], args[1], resolve]))"
+)
+EXTRACT_TILES_ASYNC_JS = "() => {" + EXTRACT_TILES_JS + "}"
+# "tiles" / "empty" once the listing has rendered either, else false (for wait_for_function)
+LISTING_STATE_ASYNC_JS = (
+    "() => document.querySelector(\"[data-testid*='product'][data-testid*='item']\") ? 'tiles'"
+    " : ((function () {" + EMPTY_LISTING_JS + "})() ? 'empty' : false)"
+)
+
+DUTCHIE_IFRAME_SELECTOR = "iframe#dutchie--embed__iframe, iframe[id*='dutchie'], iframe[src*='dutchie.com/embedded-menu']"
+PRODUCT_TILE_SELECTOR = "div[data-testid='product-list-item']"
+
+class HostRateLimiter:
+    """
+    Spaces out navigations to the same host by at least 1/`per_second` seconds,
+    however many pages are open concurrently.
+    """
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self._next_slot = {}
+        self._locks = {}
+
+    async def acquire(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_slot.get(host, 0.0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot[host] = loop.time() + self.interval
+
+async def _open_listing_async(page, url, limiter):
+    """
+    Async counterpart of open_terrabis_with_brand: host page, age gate, Dutchie
+    iframe, cookie banner, first tiles. Returns the iframe's Frame and the listing
+    state ("tiles" or "empty"), or (None, None) on timeout.
+    """
+    await limiter.acquire(url)
+    with stage_tracer.stage("navigate"):
+        await page.goto(url, wait_until="domcontentloaded", timeout=45000)
+
+    with stage_tracer.stage("age_gate"):
+        try:
+            await page.click("a.pum-close.elementor-element-ebd2f15", timeout=15000)
+        except PlaywrightTimeoutError:
+            print("Age-gate close not found or already closed.")
+
+    try:
+        with stage_tracer.stage("iframe_switch"):
+            handle = await page.wait_for_selector(DUTCHIE_IFRAME_SELECTOR, state="attached", timeout=25000)
+            frame = await handle.content_frame()
+            await frame.wait_for_load_state("domcontentloaded", timeout=10000)
+
+        # optional cookie
+        try:
+            await frame.click("button:has-text('Accept')", timeout=4000)
+        except PlaywrightTimeoutError:
+            pass
+
+        with stage_tracer.stage("tile_wait"):
+            started = time.time()
+            deadline = adaptive_timeouts.timeout("listing", 35)
+            try:
+                state = await frame.wait_for_function(LISTING_STATE_ASYNC_JS, timeout=deadline * 1000)
+            except PlaywrightTimeoutError:
+                if deadline >= 35:
+                    raise
+                # slow but maybe healthy: wait out the rest of the default deadline once
+                adaptive_timeouts.retried("listing")
+                state = await frame.wait_for_function(LISTING_STATE_ASYNC_JS, timeout=(35 - deadline) * 1000)
+            adaptive_timeouts.observe("listing", time.time() - started)
+        return frame, await state.json_value()
+    except (PlaywrightTimeoutError, AttributeError) as e:
+        print(f"Timed out waiting for the Dutchie embed at {url}: {e}")
+        return None, None
+
+async def _select_weight_async(frame, normalized_weight):
+    """Async scrape_weight: a weight that cannot be selected is reported and the tiles are still read."""
+    with stage_tracer.stage("weight_filter"):
+        try:
+            links = await frame.query_selector_all("a.weight__Anchor-sc-10b36p8-0.geHygR")
+            index, label = pick_weight_option([await link.inner_text() for link in links], normalized_weight)
+            if index is None:
+                print(f"⚠️ Weight '{label}' not found.")
+                return False
+            await links[index].click()
+            print(f"✔ Selected weight: {label}")
+            return True
+        except Exception as e:
+            print(f"⚠️ Could not select weight '{normalized_weight}'. Error: {e}")
+            return False
+
+async def _tiles_settled_async(frame, timeout=10, stable_polls=3):
+    """Async wait_for_tiles_settled: stable tile count, then a quiet DOM."""
+    with stage_tracer.stage("tiles_settle"):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        count, stable = -1, 0
+        while loop.time() < deadline and stable < stable_polls:
+            current = await frame.locator(PRODUCT_TILE_SELECTOR).count()
+            if current and current == count:
+                stable += 1
+            else:
+                count, stable = current, 0
+            await asyncio.sleep(0.25)
+        if stable >= stable_polls:
+            remaining = max(1.0, deadline - loop.time())
+            await frame.evaluate(DOM_QUIET_ASYNC_JS, [400, int(remaining * 1000)])
+        return max(count, 0)
+
+async def scrape_listing_async(browser, group_key, semaphore, limiter, block_patterns, block_types=frozenset()):
+    """
+    Opens one listing in a fresh browser context and returns its product
+    snapshot ([] when nothing is listed), or None when the listing never opened.
+    """
+    website_cat, mapped_brand, normalized_weight = group_key
+    url = build_terrabis_url("grayville", website_cat, mapped_brand)
+    # each listing runs in its own task, so this context stays with it
+    stage_tracer.set_context(listing=" / ".join(str(part) for part in group_key if part))
+    async with semaphore:
+        context = await browser.new_context(
+            user_agent=(
+                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+            ),
+            locale="en-US",
+            timezone_id="America/Chicago",
+            geolocation={"latitude": 38.4142, "longitude": -88.0039, "accuracy": 50},
+            permissions=["geolocation"],
+            viewport={"width": 1920, "height": 1080},
+        )
+        if block_patterns or block_types:
+            async def _block(route):
+                if should_block_request(route.request.url, route.request.resource_type, block_patterns, block_types):
+                    await route.abort()
+                else:
+                    await route.continue_()
+            await context.route("**/*", _block)
+        try:
+            page = await context.new_page()
+            with stage_tracer.stage("open_listing"):
+                frame, state = await _open_listing_async(page, url, limiter)
+            if frame is None:
+                return None
+            if state == "empty":
+                if mapped_brand is not None and not brand_confirmed(website_cat, mapped_brand):
+                    # no UI brand fallback here: an unconfirmed brand's empty listing counts as not opened
+                    print(f"⚠️ Brand URL filter for {group_key} shows no products and the brand is unconfirmed.")
+                    return None
+                print(f"⚠️ No products found for {group_key}.")
+                return []
+            if normalized_weight is not None:
+                await _select_weight_async(frame, normalized_weight)
+            await _tiles_settled_async(frame)
+            with stage_tracer.stage("extract"):
+                products = normalize_tiles(await frame.evaluate(EXTRACT_TILES_ASYNC_JS))
+            print(f"Snapshot for {group_key}: {len(products)} product tile(s).")
+            return products
+        except PlaywrightTimeoutError as e:
+            print(f"⚠️ No products found for {group_key}: {e}")
+            return []
+        finally:
+            await context.close()
+
+async def scrape_groups_async(group_keys, results, concurrency=4, per_host_rate=2.0):
+    """
+    Scrapes every listing in `group_keys` concurrently on a single browser
+    process. Each finished listing is put on `results` as (group_key, products),
+    followed by a final (None, "playwright").
+    """
+    try:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        limiter = HostRateLimiter(per_host_rate)
+        block_patterns = blocked_url_patterns(resource_block_profile)
+        block_types = blocked_resource_types(resource_block_profile)
+        async with async_playwright() as pw:
+            with stage_tracer.stage("driver_start"):
+                browser = await pw.chromium.launch(
+                    executable_path=_find_chrome_binary(),
+                    headless=True,
+                    args=["--no-sandbox", "--disable-dev-shm-usage", "--disable-blink-features=AutomationControlled"],
+                )
+            try:
+                async def _one(group_key):
+                    try:
+                        products = await scrape_listing_async(browser, group_key, semaphore, limiter, block_patterns, block_types)
+                    except Exception as e:
+                        print(f"Scraping {group_key} failed: {e}")
+                        products = None
+                    if products:
+                        store_snapshot(group_key, products)
+                    results.put((group_key, products))
+                await asyncio.gather(*(_one(group_key) for group_key in group_keys))
+            finally:
+                await browser.close()
+    except Exception as e:
+        st.error(f"Playwright engine could not start a browser: {e}")
+    finally:
+        results.put((None, "playwright"))
+
+def scrape_groups_with_playwright(scrape_groups, concurrency=4, per_host_rate=2.0):
+    """
+    Yields (group_key, products) in plan order. Cached and HTTP-served listings
+    are resolved up front; the rest run on the async engine in a background
+    thread. There is no UI brand-filter fallback here: a listing whose URL
+    filter fails comes back as None.
+    """
+    results = queue.Queue()
+    to_browse = []
+    for group_key in scrape_groups:
+        products = cached_snapshot(group_key)
+        if products is None:
+            products = http_snapshot(group_key)
+            store_snapshot(group_key, products)
+        if products is None:
+            to_browse.append(group_key)
+        else:
+            results.put((group_key, products))
+    results.put((None, "cache"))
+
+    running = 1
+    thread = None
+    if to_browse:
+        thread = threading.Thread(
+            target=lambda: asyncio.run(scrape_groups_async(to_browse, results, concurrency, per_host_rate)),
+            daemon=True,
+        )
+        add_script_run_ctx(thread, get_script_run_ctx())
+        thread.start()
+        running += 1
+
+    yield from yield_in_plan_order(list(scrape_groups), results, running)
+    if thread is not None:
+        thread.join()
+
+class ProductIndex:
+    """
+    Inverted index over one product snapshot, built once per listing.
+    Maps keyword token → products containing it, plus quantity, flavor and
+    weight lookups used as pre-filters, so a row only scores products that
+    share at least one keyword with it and can pass the strict checks.
+    """
+
+    def __init__(self, products, analyzer=None):
+        analyzer = analyzer or name_analyzer
+        self.products = products
+        self.features = [analyzer.analyze(p["name"]) for p in products]
+        self.postings = {}        # token -> {product position}
+        self.by_quantity = {}     # (qty, unit) -> {product position}
+        self.without_quantity = set()
+        self.by_flavor = {}       # flavor -> {product position}
+        self.by_weight = {}       # normalized weight token -> {product position}
+        for i, f in enumerate(self.features):
+            for t in f.base_token_set:
+                self.postings.setdefault(t, set()).add(i)
+            if f.qty_num is None:
+                self.without_quantity.add(i)
+            else:
+                self.by_quantity.setdefault((f.qty_num, f.qty_unit), set()).add(i)
+            for flavor in f.flavors:
+                self.by_flavor.setdefault(flavor, set()).add(i)
+            for w in f.weight_tokens:
+                self.by_weight.setdefault(normalize_weight(w), set()).add(i)
+
+    def __len__(self):
+        return len(self.products)
+
+    def candidates(self, keyword_tokens, excel, normalized_weight=None):
+        """
+        Positions (in listing order) of products that share a keyword token with
+        the row and pass the quantity, flavor and (when given) exact-weight checks.
+        Products sharing no keyword token would score 0% and are never visited.
+        """
+        ids = set()
+        for t in keyword_tokens:
+            ids |= self.postings.get(t, set())
+        if ids and excel.qty_num is not None:
+            # a site product without a quantity is not held against the row
+            ids &= self.by_quantity.get((excel.qty_num, excel.qty_unit), set()) | self.without_quantity
+        for flavor in excel.flavors:
+            if not ids:
+                break
+            ids &= self.by_flavor.get(flavor, set())
+        if ids and normalized_weight is not None:
+            ids &= self.by_weight.get(normalized_weight, set())
+        return sorted(ids)
+
+@traced("match")
+def match_row_to_products(row, index):
+    """
+    Scores one Excel row against a listing's ProductIndex.
+    Returns a dict with the matched URLs/prices/THC, the best match and the threshold used.
+    """
+    website_cat, brand, _, normalized_weight = row_scrape_context(row)
+    brand_tokens = brand_token_set(brand)
+    category_tokens = category_token_set(website_cat)
+
+    # grab the target from Excel
+    target_name = row['Product Name']
+    excel = name_analyzer.analyze(target_name)
+    excel_flavors = sorted(excel.flavors)
+
+    excel_keyword_tokens_list = excel.keyword_tokens(brand_tokens, category_tokens)
+    excel_keyword_tokens_set = set(excel_keyword_tokens_list)
+    excel_tokens_display = [t.title() for t in excel_keyword_tokens_list]
+
+    st.write(f"🔎 **Product name:** {target_name}")
+    print(f"⚖️ **Excel weight tokens:** {', '.join(excel.weight_tokens)}")
+    print(f"📦 **Excel quantity:** {excel.qty_num} {excel.qty_unit if excel.qty_unit else 'N/A'}")
+    print(f"🎨 **Excel flavors:** {', '.join(excel_flavors) if excel_flavors else 'N/A'}") # Display extracted flavors
+    print(f"🔍 **Excel tokens (cleaned):** {', '.join(excel_tokens_display)}") # Now truly cleaned
+
+    # Initialize lists to store multiple matches if fuzzy matching
+    matched_urls = []
+    matched_discounted_prices = []
+    matched_original_prices = []
+    matched_thc_contents = []
+
+    best_match_name, best_score = None, 0.0
+
+    if len(excel_keyword_tokens_set) <= FEW_TOKENS_MAX:
+        match_threshold = MATCH_THRESHOLD_FEW_TOKENS
+        print(f"Threshold set to {match_threshold:.0%} due to <= {FEW_TOKENS_MAX} Excel tokens.")
+    else:
+        match_threshold = MATCH_THRESHOLD_MANY_TOKENS
+        print(f"Threshold set to {match_threshold:.0%} due to > {FEW_TOKENS_MAX} Excel tokens.")
+
+    # Only products sharing a keyword that also pass the quantity, flavor and
+    # (for no-weight categories) exact weight checks are scored
+    candidates = index.candidates(
+        excel_keyword_tokens_set, excel,
+        normalized_weight=normalized_weight if website_cat in no_weight_categories else None
+    )
+    print(f"Scoring {len(candidates)} of {len(index)} product(s) for “{target_name}”.")
+
+    for i in candidates:
+        product = index.products[i]
+        site = index.features[i]
+        name = product["name"]
+        url = product["url"]
+        discounted_price = product["discounted"]
+        original_price = product["original"]
+        thc_content = product["thc"]
+
+        site_keyword_tokens_list = site.keyword_tokens(brand_tokens, category_tokens)
+        site_tokens_display = [t.title() for t in site_keyword_tokens_list] # For display
+
+        print(f"⚖️ **Site weight tokens for “{name}”:** {', '.join(site.weight_tokens)}")
+        print(f"📦 **Site quantity for “{name}”:** {site.qty_num} {site.qty_unit if site.qty_unit else 'N/A'}")
+        print(f"🎨 **Site flavors for “{name}”:** {', '.join(sorted(site.flavors)) if site.flavors else 'N/A'}") # Display extracted site flavors
+        print(f"👁️ **Site tokens for “{name}” (cleaned):** {', '.join(site_tokens_display)}")
+        print(f"💰 **Site Price for “{name}”:** Discounted: {discounted_price}, Original: {original_price}")
+        print(f"🌿 **Site THC for “{name}”:** {thc_content}")
+        print(f"🌐 **Site URL for “{name}”:** {url}")
+
+        # compare on lowercase using the cleaned keyword token sets
+        common = excel_keyword_tokens_set.intersection(site_keyword_tokens_list)
+        print(f"🔗 **Common tokens:** {', '.join(t.title() for t in common)}")
+
+        # compute score based only on keyword tokens
+        score = len(common) / len(excel_keyword_tokens_set)
+        print(f"      Score for “{name}”: {score:.0%}")
+
+        if score >= match_threshold:
+            # Collect all valid matches, several products could fuzzy match
+            matched_urls.append(url)
+            matched_discounted_prices.append(discounted_price)
+            matched_original_prices.append(original_price)
+            matched_thc_contents.append(thc_content)
+
+            # Update best_match for display purposes if a higher score is found
+            if score > best_score:
+                best_match_name = name
+                best_score = score
+
+    return {
+        "target_name": target_name,
+        "urls": matched_urls,
+        "discounted_prices": matched_discounted_prices,
+        "original_prices": matched_original_prices,
+        "thc_contents": matched_thc_contents,
+        "best_match_name": best_match_name,
+        "best_score": best_score,
+        "threshold": match_threshold,
+    }
+
+def _incidence(entries, n_rows, vocab):
+    """Sparse 0/1 matrix from (row, key) pairs; keys are columns in `vocab`."""
+    rows = [r for r, key in entries]
+    cols = [vocab[key] for r, key in entries]
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n_rows, max(len(vocab), 1))
+    )
+
+def _pair_values(matrix, r, p):
+    """Values of a sparse matrix at the (r[i], p[i]) coordinates."""
+    if len(r) == 0:
+        return np.zeros(0)
+    return np.asarray(matrix.tocsr()[r, p]).ravel()
+
+@traced("match")
+def match_sheet(data, catalogs, analyzer=None):
+    """
+    Matches every row of `data` against its listing's catalog in one pass.
+    `catalogs` maps group_key → product list (None when the listing could not be
+    opened). Returns a DataFrame indexed like `data` with the same fields as
+    match_row_to_products plus `has_catalog`.
+
+    Rows and products become sparse token-incidence matrices whose columns are
+    (catalog, token) pairs, so one sparse product R·Pᵀ yields the shared-keyword
+    count of every row×product pair from the same listing. Quantity, flavor and
+    exact-weight checks are then applied to the non-zero pairs only.
+    """
+    analyzer = analyzer or name_analyzer
+    catalog_ids = {key: g for g, key in enumerate(catalogs)}
+
+    # --- product side: all catalogs concatenated in listing order ---
+    products, product_gid, product_features = [], [], []
+    for key, catalog in catalogs.items():
+        for product in catalog or []:
+            products.append(product)
+            product_gid.append(catalog_ids[key])
+            product_features.append(analyzer.analyze(product["name"]))
+
+    # --- row side ---
+    row_ids = list(data.index)
+    row_gid = np.full(len(row_ids), -1)
+    row_features, row_keywords, enforce_weight, row_weight = [], [], [], []
+    for r, (row_index, row) in enumerate(data.iterrows()):
+        website_cat, brand, _, normalized_weight = row_scrape_context(row)
+        key = group_key_for_row(row)
+        if catalogs.get(key) is not None:
+            row_gid[r] = catalog_ids[key]
+        features = analyzer.analyze(row['Product Name'])
+        row_features.append(features)
+        row_keywords.append(set(features.keyword_tokens(brand_token_set(brand), category_token_set(website_cat))))
+        enforce_weight.append(website_cat in no_weight_categories)
+        row_weight.append(normalized_weight)
+
+    # --- (catalog, token) incidence matrices ---
+    token_vocab, flavor_vocab, weight_vocab = {}, {}, {}
+    row_tokens, row_flavors, row_weights = [], [], []
+    for r, g in enumerate(row_gid):
+        if g < 0:
+            continue
+        for t in row_keywords[r]:
+            token_vocab.setdefault((g, t), len(token_vocab))
+            row_tokens.append((r, (g, t)))
+        for f in row_features[r].flavors:
+            flavor_vocab.setdefault((g, f), len(flavor_vocab))
+            row_flavors.append((r, (g, f)))
+        if enforce_weight[r]:
+            weight_vocab.setdefault((g, row_weight[r]), len(weight_vocab))
+            row_weights.append((r, (g, row_weight[r])))
+
+    product_tokens, product_flavors, product_weights = [], [], []
+    for p, (g, f) in enumerate(zip(product_gid, product_features)):
+        # tokens no row asked for cannot contribute to any score
+        product_tokens.extend((p, (g, t)) for t in f.base_token_set if (g, t) in token_vocab)
+        product_flavors.extend((p, (g, fl)) for fl in f.flavors if (g, fl) in flavor_vocab)
+        product_weights.extend(
+            (p, (g, w)) for w in {normalize_weight(wt) for wt in f.weight_tokens} if (g, w) in weight_vocab
+        )
+
+    n_rows, n_products = len(row_ids), len(products)
+    R = _incidence(row_tokens, n_rows, token_vocab)
+    P = _incidence(product_tokens, n_products, token_vocab)
+    overlap = (R @ P.T).tocoo()
+    r, p, shared = overlap.row, overlap.col, overlap.data.astype(float)
+
+    n_keywords = np.array([len(k) for k in row_keywords], dtype=float)
+    thresholds = np.where(n_keywords <= FEW_TOKENS_MAX, MATCH_THRESHOLD_FEW_TOKENS, MATCH_THRESHOLD_MANY_TOKENS)
+    scores = shared / np.maximum(n_keywords[r], 1)
+    passed = scores >= thresholds[r]
+
+    # quantity: only enforced when both names carry one
+    row_qty = np.array([f.qty_num if f.qty_num is not None else np.nan for f in row_features], dtype=float)
+    product_qty = np.array([f.qty_num if f.qty_num is not None else np.nan for f in product_features], dtype=float)
+    row_unit = np.array([f.qty_unit for f in row_features], dtype=object)
+    product_unit = np.array([f.qty_unit for f in product_features], dtype=object)
+    if len(r):
+        passed &= (
+            np.isnan(row_qty[r]) | np.isnan(product_qty[p])
+            | ((row_qty[r] == product_qty[p]) & (row_unit[r] == product_unit[p]))
+        )
+
+    # flavors: every Excel flavor must appear on the site product
+    n_flavors = np.array([len(f.flavors) for f in row_features])
+    if flavor_vocab and len(r):
+        shared_flavors = _pair_values(
+            _incidence(row_flavors, n_rows, flavor_vocab) @ _incidence(product_flavors, n_products, flavor_vocab).T, r, p
+        )
+        passed &= shared_flavors == n_flavors[r]
+    else:
+        passed &= n_flavors[r] == 0
+
+    # exact weight for categories without a weight filter on the site
+    enforce = np.array(enforce_weight, dtype=bool)
+    if weight_vocab and len(r):
+        same_weight = _pair_values(
+            _incidence(row_weights, n_rows, weight_vocab) @ _incidence(product_weights, n_products, weight_vocab).T, r, p
+        ) > 0
+        passed &= ~enforce[r] | same_weight
+    else:
+        passed &= ~enforce[r]
+
+    # --- collect matches per row, in listing order ---
+    records = []
+    for i, row_index in enumerate(row_ids):
+        records.append({
+            "target_name": row_features[i].name,
+            "urls": [], "discounted_prices": [], "original_prices": [], "thc_contents": [],
+            "best_match_name": None, "best_score": 0.0,
+            "threshold": float(thresholds[i]),
+            "has_catalog": bool(row_gid[i] >= 0),
+        })
+    r, p, scores = r[passed], p[passed], scores[passed]
+    for k in np.lexsort((p, r)):
+        record, product, score = records[r[k]], products[p[k]], scores[k]
+        record["urls"].append(product["url"])
+        record["discounted_prices"].append(product["discounted"])
+        record["original_prices"].append(product["original"])
+        record["thc_contents"].append(product["thc"])
+        if score > record["best_score"]:
+            record["best_match_name"] = product["name"]
+            record["best_score"] = float(score)
+    return pd.DataFrame.from_records(records, index=row_ids)
+
+def record_match_result(row_index, result):
+    """
+    Shows a row's match outcome and saves it into the results workbook.
+    """
+    if result["urls"]: # If any matches were found
+        st.success(f"✅ Matched “{result['target_name']}” → “{result['best_match_name']}” ({result['best_score']:.0%})")
+        st.write(f"   **URL(s):** {', '.join(result['urls'])}")
+        st.write(f"   **Price(s):** Discounted: {', '.join(map(str, result['discounted_prices']))} (Original: {', '.join(map(str, result['original_prices']))})")
+        st.write(f"   **THC(s):** {', '.join(result['thc_contents'])}")
+        # Save the collected data for this row
+        save_data_to_file(row_index, result["discounted_prices"], result["original_prices"], result["thc_contents"], result["urls"],
+                          best_match=result["best_match_name"], score=result["best_score"])
+    else:
+        st.warning(f"⚠️ No ≥{int(result['threshold'] * 100)}% match for “{result['target_name']}” (including quantity, weight, and flavor comparisons).")
+        # When no match, save blanks for the current row
+        save_data_to_file(row_index, " ", " ", " ", " ", best_match=result["best_match_name"], score=result["best_score"])
+
+def load_cached_catalogs(data, cache):
+    """
+    {group_key: products} for every listing the rows need, read from the snapshot
+    cache without a browser. Listings that were never scraped map to None.
+    """
+    return {key: cache.load(snapshot_cache_key(key)) for key in plan_scrape_groups(data)}
+
+def write_match_results(matches):
+    """
+    Saves a match_sheet table into the results workbook without per-row UI output.
+    Rows without a catalog are left untouched. Returns the number of rows written.
+    """
+    written = 0
+    for row_index, result in matches.iterrows():
+        if not result["has_catalog"]:
+            continue
+        if result["urls"]:
+            save_data_to_file(row_index, result["discounted_prices"], result["original_prices"], result["thc_contents"], result["urls"])
+        else:
+            save_data_to_file(row_index, " ", " ", " ", " ")
+        written += 1
+    return written
+
+def show_download_button(uploaded_file):
+    """Offers the updated workbook currently held in `excel_buffer`."""
+    if excel_buffer is not None:
+        st.download_button(
+            label="Download Updated Excel File",
+            data=excel_buffer.getvalue(), # Get the BytesIO content
+            file_name=f"updated_{uploaded_file.name}",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+def show_results_log_download(slot, uploaded_file):
+    """(Re)draws the streaming results log's download button in `slot`."""
+    if results_stream is None:
+        return
+    results_stream.downloads += 1
+    slot.download_button(
+        label=f"Download results so far (CSV, {results_stream.rows} row(s))",
+        data=results_stream.read_bytes(),
+        file_name=f"results_{os.path.splitext(uploaded_file.name)[0]}.csv",
+        mime="text/csv",
+        on_click="ignore",
+        key=f"results_log_{results_stream.downloads}",
+    )
+
+# Custom CSS to style the app
+st.markdown("""
+    <style>
+        /* Center the title */
+        .title {
+            text-align: center;
+            color: #000000;
+            font-size: 32px;
+        }
+
+        /* Style the main page background */
         .stApp {
             background-color: #F4F7FC; /* Light Gray-Blue */
         }
@@ -1226,6 +3886,9 @@ st.sidebar.markdown("""
 """)
 
 # File Upload in Sidebar
+# Sidebar choice that scrapes every category of the sheet in one run
+ALL_CATEGORIES = "All categories"
+
 uploaded_file = st.sidebar.file_uploader("Upload Excel File", type=['xlsx'])
 
 if uploaded_file:
@@ -1240,541 +3903,275 @@ if uploaded_file:
     categories = df['Category'].unique()
     brands = df['Brand'].unique()
 
-    # Dropdown in Sidebar for Category Selection
-    selected_category = st.sidebar.selectbox("Select Category to Scrap", categories)
-    
+    # Dropdown in Sidebar for Category Selection ("All categories" runs the whole sheet as one job)
+    selected_category = st.sidebar.selectbox("Select Category to Scrap", list(categories) + [ALL_CATEGORIES])
+    whole_sheet = selected_category == ALL_CATEGORIES
+
     # Filter the data based on the selected category
-    filtered_data = df[df['Category'] == selected_category]
+    filtered_data = df if whole_sheet else df[df['Category'] == selected_category]
 
     # Show the number of products in the selected category
     num_products = len(filtered_data)
     st.write('-------------------------------------------------------------------------')
-    st.write(f"Number of products in the '{selected_category}' category: {num_products}")
+    if whole_sheet:
+        st.write(f"Number of products in the sheet ({filtered_data['Category'].nunique()} categories): {num_products}")
+    else:
+        st.write(f"Number of products in the '{selected_category}' category: {num_products}")
 
-    # Button to Start Scraping
-    if st.sidebar.button('Start Scraping'):
-        st.write("Scraping started for category:", selected_category)
+    # How often the open results workbook is written back into the download buffer
+    checkpoint_every = st.sidebar.number_input(
+        "Save results every N rows (0 = only at the end)", min_value=0, value=50, step=10
+    )
 
-        # Initialize the driver once and pass it to both category and brand selection functions
-        driver, wait = get_driver()
+    # Selenium drives one Chrome per worker; Playwright runs many pages on one browser process
+    browser_engine = st.sidebar.selectbox("Browser engine", ["Selenium (undetected-chromedriver)", "Playwright (async)"])
+    if browser_engine.startswith("Playwright"):
+        playwright_concurrency = st.sidebar.number_input("Concurrent pages", min_value=1, max_value=32, value=6, step=1)
+        playwright_rate = st.sidebar.number_input("Page loads per second per host", min_value=0.0, value=2.0, step=0.5)
 
-        driver.current_category = selected_category
+    # Number of independent Chrome drivers working through the listings
+    parallel_drivers = st.sidebar.number_input(
+        "Parallel browsers", min_value=1, max_value=max_parallel_drivers(), value=1, step=1
+    )
 
-        # Start the category selection process
-        category_found = scrape_category(selected_category, driver)
+    # Replace each browser periodically so long runs don't creep in memory or wedge
+    driver_recycle_pages = st.sidebar.number_input("Recycle browser after N listings (0 = never)", min_value=0, value=40, step=10)
+    driver_recycle_heap_mb = st.sidebar.number_input("Recycle browser above JS heap (MB, 0 = off)", min_value=0, value=512, step=64)
 
-        if not category_found:
-            # Quit the driver and stop the script if the category wasn't found
-            driver.quit()
-            st.warning("Scraping stopped because the category was not found on the website.")
-            # Use 'st.stop()' to halt execution in a Streamlit app
-            st.stop()
+    # Optional browser-free product source (Dutchie GraphQL); the browser remains the fallback
+    use_http_source = st.sidebar.checkbox("Fetch menu over HTTP (browser as fallback)", value=False)
+    dutchie_dispensary_id = st.sidebar.text_input("Dutchie dispensary ID", value=DUTCHIE_DISPENSARY_ID)
+    dutchie_query_hash = st.sidebar.text_input("FilteredProducts query hash", value=DUTCHIE_FILTERED_PRODUCTS_HASH)
+    if use_http_source and dutchie_dispensary_id and dutchie_query_hash:
+        http_product_source = DutchieHttpSource(dutchie_dispensary_id, query_hash=dutchie_query_hash)
+    else:
+        http_product_source = None
+
+    # On-disk snapshot cache so re-runs within the TTL read listings from disk
+    use_snapshot_cache = st.sidebar.checkbox("Cache scraped listings on disk", value=True)
+    cache_ttl_hours = st.sidebar.number_input("Cache TTL (hours)", min_value=0.0, value=6.0, step=1.0)
+    cache_max_entries = st.sidebar.number_input("Cache size limit (listings)", min_value=10, value=2000, step=100)
+    force_refresh_snapshots = st.sidebar.checkbox("Force refresh (ignore cached listings)", value=False)
+    if use_snapshot_cache:
+        snapshot_cache = SnapshotCache(ttl_seconds=cache_ttl_hours * 3600, max_entries=int(cache_max_entries))
+    else:
+        snapshot_cache = None
 
-        # Store the current category URL to reload it later
-        category_url = driver.current_url
-        print("Category URL stored:", category_url)
+    # Skip rows a previous (crashed) run of this sheet/category already finished
+    resume_previous_run = st.sidebar.checkbox("Resume previous run of this sheet", value=True)
 
-        # Filter brands based on the selected category and scrape
-        relevant_brands = df[df['Category'] == selected_category]['Brand'].tolist()
+    # What each browser skips downloading (images, media, fonts, trackers)
+    resource_block_profile = st.sidebar.selectbox(
+        "Block page resources", list(RESOURCE_PROFILES), index=list(RESOURCE_PROFILES).index("lean"),
+        help="trackers: analytics/ad hosts. lean: also video/audio and web-font files and font hosts. "
+             "aggressive: also images. The menu's own scripts and API calls always load."
+    )
 
-        # Loop through the brands and select them
-        for row_index, row in filtered_data.iterrows():
-            # Reload the category page so all filters are cleared
-            driver.switch_to.default_content()
-            driver.get(category_url)
+    # One unfiltered listing per category, brand/weight filtered in memory (Selenium engine)
+    use_full_catalog = st.sidebar.checkbox("Full catalog mode (load each category once)", value=False)
+    full_catalog_source = FullCatalogSource() if use_full_catalog else None
+
+    # Check every brand against the site's brand list before loading any listing
+    resolve_brands_up_front = st.sidebar.checkbox("Resolve brands against the site first", value=True)
+    brand_resolutions.update(load_brand_resolutions())
+
+    # Keep each browser inside the Dutchie menu and switch brands in-app
+    warm_session_mode = st.sidebar.checkbox("Warm session (switch listings inside the menu)", value=True)
+
+    # Per-product scoring log (slower); otherwise rows are matched in bulk per listing
+    verbose_matching = st.sidebar.checkbox("Log per-product match details", value=False)
+
+    # Re-run only matching + write-back against listings stored by earlier runs
+    run_mode = st.sidebar.radio("Mode", ["Scrape website", "Re-match stored listings (no browser)"])
+
+    if run_mode.startswith("Re-match"):
+        if st.sidebar.button('Re-match'):
+            started = time.time()
+            start_results_writer(checkpoint_every=0)
+            catalogs = load_cached_catalogs(filtered_data, snapshot_cache or SnapshotCache())
+            missing = [key for key, products in catalogs.items() if products is None]
+            if missing:
+                st.warning(f"{len(missing)} of {len(catalogs)} listing(s) have no stored snapshot; their rows are left unchanged.")
+                st.write("Listings without a snapshot:", [" / ".join(str(part) for part in key if part) for key in missing])
+            matches = match_sheet(filtered_data, catalogs)
+            written = write_match_results(matches)
+            flush_results_to_file()
+            matched = int((matches["urls"].map(len) > 0).sum())
+            st.success(f"Re-matched {written} row(s) in {time.time() - started:.2f}s: {matched} matched.")
+            st.dataframe(pd.DataFrame({
+                "Product Name": matches["target_name"],
+                "Best match": matches["best_match_name"],
+                "Score": matches["best_score"].map(lambda v: f"{v:.0%}"),
+                "Matches": matches["urls"].map(len),
+            }))
+            show_download_button(uploaded_file)
+        st.stop()
 
-            # --- START NEW CODE BLOCK: Handle IFRAME and Wait for Products ---
-            # --- START NEW CODE BLOCK: Handle IFRAME and Wait for Products ---
-            # try:
-            #     time.sleep(1.0)
-            
-            #     # Find the Dutchie iframe (and capture its src for a fallback)
-            #     iframe = WebDriverWait(driver, 15).until(
-            #         EC.presence_of_element_located((
-            #             By.CSS_SELECTOR,
-            #             "iframe#dutchie--embed__iframe, iframe[id*='dutchie'], iframe[src*='dutchie.com']"
-            #         ))
-            #     )
-            #     iframe_src = iframe.get_attribute("src") or ""
-            #     WebDriverWait(driver, 10).until(lambda d: iframe.get_attribute("src") and "about:blank" not in iframe.get_attribute("src"))
-            
-            #     # Try switching INTO the iframe first
-            #     try:
-            #         WebDriverWait(driver, 15).until(EC.frame_to_be_available_and_switch_to_it(iframe))
-            #         st.info(f"Switched to Dutchie iframe for row {row_index}.")
-            
-            #         # DOM ready, then wait for products
-            #         WebDriverWait(driver, 15).until(lambda d: d.execute_script("return document.readyState") in ("interactive", "complete"))
-            
-            #         # Close cookie/banner if it appears
-            #         try:
-            #             cookie_btn = WebDriverWait(driver, 3).until(EC.element_to_be_clickable((
-            #                 By.XPATH,
-            #                 "//button[normalize-space()='Accept' or normalize-space()='Accept all' or contains(translate(.,'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'accept')]"
-            #             )))
-            #             stable_click(driver, cookie_btn)
-            #             time.sleep(0.4)
-            #         except Exception:
-            #             pass
-            
-            #         # Wait for product tiles (several possible selectors)
-            #         WebDriverWait(driver, 25).until(EC.any_of(
-            #             EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-testid='product-list-item']")),
-            #             EC.presence_of_all_elements_located((By.CSS_SELECTOR, "[data-testid*='product'][data-testid*='item']")),
-            #             EC.presence_of_all_elements_located((By.XPATH, "//div[contains(@class,'product') and (contains(@class,'card') or contains(@class,'item'))]"))
-            #         ))
-            #         time.sleep(0.8)  # let prices/options hydrate
-            
-            #     except TimeoutException:
-            #         # Fallback: open the Dutchie menu directly (avoids headless iframe issues)
-            #         driver.switch_to.default_content()
-            #         if not iframe_src:
-            #             raise  # no URL to open; let outer handler catch
-            
-            #         st.info("Iframe slow/blocked; opening Dutchie menu directly.")
-            #         driver.get(iframe_src)
-            
-            #         # Grant geo on dutchie.com (helps some locations)
-            #         try:
-            #             driver.execute_cdp_cmd("Browser.grantPermissions", {
-            #                 "origin": "https://dutchie.com",
-            #                 "permissions": ["geolocation"]
-            #             })
-            #             # Grayville-ish (adjust if you like)
-            #             driver.execute_cdp_cmd("Emulation.setGeolocationOverride", {
-            #                 "latitude": 38.4142, "longitude": -88.0039, "accuracy": 50
-            #             })
-            #         except Exception:
-            #             pass
-            
-            #         WebDriverWait(driver, 20).until(lambda d: d.execute_script("return document.readyState") in ("interactive", "complete"))
-            
-            #         # Close cookie/banner if present
-            #         try:
-            #             cookie_btn = WebDriverWait(driver, 5).until(EC.element_to_be_clickable((
-            #                 By.XPATH,
-            #                 "//button[normalize-space()='Accept' or normalize-space()='Accept all' or contains(translate(.,'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'accept')]"
-            #             )))
-            #             stable_click(driver, cookie_btn)
-            #             time.sleep(0.4)
-            #         except Exception:
-            #             pass
-            
-            #         # Wait for product tiles on the full dutchie page
-            #         WebDriverWait(driver, 30).until(EC.any_of(
-            #             EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-testid='product-list-item']")),
-            #             EC.presence_of_all_elements_located((By.CSS_SELECTOR, "[data-testid*='product'][data-testid*='item']"))
-            #         ))
-            #         time.sleep(0.8)
-            
-            # except TimeoutException as e:
-            #     st.error(f"Timed out waiting for Dutchie menu for row {row_index}. Error: {e}")
-            
-            #     # Debug helpers
-            #     try:
-            #         driver.switch_to.default_content()
-            #         iframes = driver.find_elements(By.TAG_NAME, "iframe")
-            #         st.write("Iframes on page:", [f.get_attribute("src") for f in iframes])
-            #         st.image(driver.get_screenshot_as_png(), caption="Screenshot at timeout", use_container_width=True)
-            #     except Exception:
-            #         pass
-            
-            #     save_data_to_file(row_index, " ", " ", " ", " ")
-            #     try:
-            #         driver.switch_to.default_content()
-            #     except Exception:
-            #         pass
-            #     continue
-            
-            # except Exception as e:
-            #     st.error(f"Unexpected error while entering Dutchie for row {row_index}: {e}")
-            #     save_data_to_file(row_index, " ", " ", " ", " ")
-            #     try:
-            #         driver.switch_to.default_content()
-            #     except Exception:
-            #         pass
-            #     continue
-            # # --- END NEW CODE BLOCK ---
-
-
-
-            # Extract the relevant data
-            selected_category = row['Category']
-            brand = str(row['Brand'])
-            # build a set of this row’s brand tokens (collapse spaces & lowercase)
-            raw_brand = TOKEN_RE.findall(brand)
-            brand_tokens = {t.replace(" ", "").lower() for t in raw_brand}
-            website_cat      = category_mapping.get(selected_category, selected_category)
-            raw_cat          = TOKEN_RE.findall(website_cat)
-            collapsed_cat    = [t.replace(" ", "") for t in raw_cat]
-            category_tokens  = set()
-            for tok in collapsed_cat:
-                lc = tok.lower()
-                category_tokens.add(lc)
-                if lc.endswith("s"):
-                    category_tokens.add(lc[:-1])
-            weight = row['Weight']  # Assuming weight is in the 'Weight' column
-
-            # Normalize the weight before passing it to scrape_weight
-            normalized_weight = normalize_weight(weight)
-
-            # Decide whether we need to select a brand
-            website_cat = category_mapping.get(selected_category, selected_category)
-            mapped_brand = brand_mapping.get(brand, brand)
-            
-            if website_cat in no_brand_categories:
-                # no brand facet on site: still open category page and switch into iframe
-                st.info(f"Opening category via URL: {website_cat} (no brand facet).")
-                brand_successfully_selected = open_terrabis_with_brand(
-                    driver, wait,
-                    city_slug="grayville",
-                    category_site_name=website_cat,
-                    brand_site_name=None,          # no brand param
-                    row_index=row_index
-                )
-            else:
-                # use URL-driven brand filter first
-                st.info(f"Applying brand via URL: {mapped_brand} in {website_cat}")
-                brand_successfully_selected = open_terrabis_with_brand(
-                    driver, wait,
-                    city_slug="grayville",
-                    category_site_name=website_cat,
-                    brand_site_name=mapped_brand,  # mapped name → slug
-                    row_index=row_index
-                )
-            
-                # optional UI fallback if URL approach failed
-                if not brand_successfully_selected:
-                    st.warning("URL brand filter failed; trying UI brand filter.")
-                    driver.switch_to.default_content()
-                    driver.get(category_url)
-                    brand_successfully_selected = scrape_brand(brand, driver)
-
-
-            # --- WEIGHT SELECTION (CONDITIONAL) ---
-            # Only proceed with weight selection if the brand was successfully selected (or skipped)
-            if brand_successfully_selected:
-                weight_successfully_selected = False
-                if website_cat in no_weight_categories:
-                    print(f"⏭ Skipping weight selection for category '{website_cat}' (no weight filter on site).")
-                    weight_successfully_selected = True # Consider weight "selected" if category doesn't require it
-                else:
-                    print(f"Selecting weight: {normalized_weight}")
-                    weight_successfully_selected = scrape_weight(normalized_weight, driver)
+    # Button to Start Scraping
+    if st.sidebar.button('Start Scraping'):
+        st.write("Scraping started for category:", selected_category)
 
-                # The product scraping and matching logic will now run only if brand_successfully_selected is True
-                # and weight_successfully_selected is True (or if they were successfully skipped).
+        # Keep one workbook open for the whole run instead of reloading it per row
+        start_results_writer(checkpoint_every=checkpoint_every)
+
+        # Per-stage timings for this run, shown live as p50/p95 per stage
+        stage_tracer.reset()
+        stage_tracer.set_context(listing="setup")
+        st.subheader("Stage timings")
+        timing_table = st.empty()
+
+        # Durable journal of finished rows; a restarted run picks up where it stopped
+        run_journal = RunJournal(run_id_for(uploaded_file.getvalue(), selected_category))
+        completed_rows = set()
+        if resume_previous_run:
+            completed_rows = resume_from_journal(run_journal)
+            if completed_rows:
+                st.info(f"Resuming: {len(completed_rows)} row(s) already completed in a previous run are skipped.")
+        else:
+            run_journal.clear()
+        pending_rows = filtered_data[~filtered_data.index.isin(completed_rows)]
+        if pending_rows.empty:
+            flush_results_to_file()
+            run_journal.clear()  # the previous run finished every row; the next run starts fresh
+            st.success("Every row of this category was already completed in a previous run.")
+            show_download_button(uploaded_file)
+            st.stop()
+
+        # Finished rows stream into a CSV log and a live table as they complete
+        results_stream = ResultsStream(
+            run_id_for(uploaded_file.getvalue(), selected_category),
+            product_names=filtered_data['Product Name'].to_dict()
+        )
+        if not completed_rows:
+            # nothing to resume: rows left by an earlier (unfinished) run are stale
+            results_stream.clear()
+        st.subheader("Results so far")
+        st.caption(f"Streaming to {results_stream.path}")
+        results_stream.attach_table(st)
+        results_download = st.empty()
+        last_results_download = 0.0
+
+        driver, wait = None, None
+        if not browser_engine.startswith("Playwright"):
+            # Initialize the driver once and pass it to both category and brand selection functions
+            driver, wait = get_driver()
+
+            if whole_sheet:
+                # every listing is opened by URL; the UI fallback opens each listing's own category page
+                category_url = None
             else:
-                # If brand was NOT successfully selected, skip weight selection and mark product as N/A
-                st.error(f"⚠️ Brand '{brand}' not found")
-                # Save empty strings for price, THC, and URL for this row
-                save_data_to_file(row_index, " ", " ", " ", " ")
-                continue # Skip the rest of the loop for this product and go to the next
+                driver.current_category = selected_category
+
+                # Start the category selection process
+                category_found = scrape_category(selected_category, driver)
+
+                if not category_found:
+                    # Quit the driver and stop the script if the category wasn't found
+                    driver.quit()
+                    st.warning("Scraping stopped because the category was not found on the website.")
+                    # Use 'st.stop()' to halt execution in a Streamlit app
+                    st.stop()
+
+                # Store the current category URL to reload it later
+                category_url = driver.current_url
+                print("Category URL stored:", category_url)
+
+            # Filter brands based on the selected category and scrape
+            relevant_brands = df[df['Category'] == selected_category]['Brand'].tolist()
+
+        # Resolve every brand against the site's own brand list, before any filtered page load
+        if resolve_brands_up_front:
+            brand_report = resolve_sheet_brands(driver, wait, pending_rows)
+            unresolved_report = brand_report[brand_report["Resolved by"] == "unresolved"]
+            if not unresolved_report.empty:
+                st.warning(f"{len(unresolved_report)} brand(s) are not offered on the site; their rows are left blank.")
+                st.dataframe(unresolved_report[["Category", "Brand"]])
+            unverified = brand_report[brand_report["Resolved by"] == "not verified"]
+            if not unverified.empty:
+                st.info(f"{len(unverified)} brand(s) were not in a partially read brand list; they are scraped as mapped.")
+            renamed = brand_report[brand_report["Resolved by"].isin(["normalized", "fuzzy"])]
+            if not renamed.empty:
+                st.info("Brands matched to a differently spelled site brand:")
+                st.dataframe(renamed)
+
+        # Group rows by listing so each (category, brand, weight) page is loaded and scraped once
+        scrape_groups = plan_scrape_groups(pending_rows, by_listing=whole_sheet)
+        st.info(f"{len(pending_rows)} row(s) grouped into {len(scrape_groups)} listing(s) to scrape.")
+
+        # Brands the site does not offer: no page load, rows written blank right away
+        for group_key in [key for key in scrape_groups if brand_unresolved(key)]:
+            for row_index in scrape_groups.pop(group_key):
+                save_data_to_file(row_index, " ", " ", " ", " ", journal=False)
+
+        if browser_engine.startswith("Playwright"):
+            # listings are opened by URL, so no category navigation is needed up front
+            st.info(f"Scraping with Playwright: up to {playwright_concurrency} concurrent page(s).")
+            snapshots = scrape_groups_with_playwright(
+                scrape_groups, concurrency=int(playwright_concurrency), per_host_rate=playwright_rate
+            )
+        elif parallel_drivers > 1:
+            st.info(f"Scraping with {parallel_drivers} parallel browsers.")
+            snapshots = scrape_groups_in_parallel(
+                scrape_groups, filtered_data, selected_category, category_url,
+                workers=parallel_drivers, driver=driver, wait=wait
+            )
+        else:
+            managed_driver = ManagedDriver(selected_category, driver, wait)
+            snapshots = scrape_groups_sequentially(managed_driver, scrape_groups, filtered_data, category_url)
 
+        for group_key, products in snapshots:
             # --- PRODUCT MATCHING START ---
-            try:
-                # wait for the product tiles to appear
-                WebDriverWait(driver, 8).until(
-                    EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-testid='product-list-item']"))
-                )
-                time.sleep(5)  # give a bit extra for everything to render
-
-                # scrape all product names on the page
-                product_tiles = driver.find_elements(By.CSS_SELECTOR, "div[data-testid='product-list-item']")
-                scraped = []
-
-                # grab the target from Excel
-                target_name = row['Product Name']
-                # Extract and normalize quantity from Excel product name
-                excel_qty_num, excel_qty_unit = extract_and_normalize_quantity(target_name)
-
-                # Identify all parts of quantity strings from the Excel product name
-                excel_quantity_parts_to_exclude = set()
-                for m in QUANTITY_RE.finditer(target_name):
-                    full_match_str = m.group(0).lower() # e.g., "10 pk", "100mg"
-                    # Tokenize the full match string using TOKEN_RE to get its constituent tokens
-                    # and add them to the set of parts to exclude
-                    for part_token in TOKEN_RE.findall(full_match_str):
-                        excel_quantity_parts_to_exclude.add(part_token.replace(" ", "").lower())
-
-                # Identify all parts of ratio strings from the Excel product name
-                excel_ratio_parts_to_exclude = set()
-                for m in RATIO_RE.finditer(target_name):
-                    full_match_str = m.group(0).lower()
-                    for part_token in TOKEN_RE.findall(full_match_str):
-                        excel_ratio_parts_to_exclude.add(part_token.replace(" ", "").lower())
-                
-                # Extract flavors from Excel product name (still needed for strict matching)
-                excel_flavors = extract_flavors(target_name, FLAVOR_LIST)
-                excel_flavor_tokens = set(excel_flavors) # Store as set for comparison
-
-                # tokenize and collapse spaces in units (so "3.5 g" → "3.5g")
-                raw_wa       = TOKEN_RE.findall(target_name)
-                collapsed_wa = [t.replace(" ", "") for t in raw_wa]
-
-                # extract weight tokens (anything starting with a digit)
-                excel_weight_tokens = [
-                    t for t in collapsed_wa
-                    if re.match(r'^\d+(?:\.\d+)?(?:g|mg|oz)$', t.lower())
-                ]
-
-                # Filter Excel tokens for keywords. Flavors are *not* excluded here.
-                excel_keyword_tokens_list = []
-                for t in collapsed_wa:
-                    normalized_t_lower = t.lower()
-                    # Check if it's a weight token
-                    if re.match(r'^\d+(?:\.\d+)?(?:g|mg|oz)$', normalized_t_lower):
-                        continue
-                    # Check if the token is part of an identified quantity
-                    if normalized_t_lower in excel_quantity_parts_to_exclude:
-                        continue
-                    # Check if the token is part of an identified ratio
-                    if normalized_t_lower in excel_ratio_parts_to_exclude:
-                        continue
-                    # Check if it's a brand/category/stopword token
-                    if normalized_t_lower in brand_tokens or \
-                       normalized_t_lower in STOPWORDS or \
-                       normalized_t_lower in category_tokens or \
-                       (normalized_t_lower.endswith("s") and normalized_t_lower[:-1] in category_tokens):
-                        continue
-                    # Flavors are NO LONGER EXCLUDED HERE; they will contribute to the general score.
-                    excel_keyword_tokens_list.append(normalized_t_lower)
-
-                # Convert to set for efficient lookup during comparison
-                excel_keyword_tokens_set = set(excel_keyword_tokens_list)
-                excel_tokens_display = [t.title() for t in excel_keyword_tokens_list]
-
-                st.write(f"🔎 **Product name:** {target_name}")
-                print(f"⚖️ **Excel weight tokens:** {', '.join(excel_weight_tokens)}")
-                print(f"📦 **Excel quantity:** {excel_qty_num} {excel_qty_unit if excel_qty_unit else 'N/A'}")
-                print(f"🎨 **Excel flavors:** {', '.join(excel_flavors) if excel_flavors else 'N/A'}") # Display extracted flavors
-                print(f"🔍 **Excel tokens (cleaned):** {', '.join(excel_tokens_display)}") # Now truly cleaned
-
-                for tile in product_tiles:
-                    name = tile.find_element(By.CSS_SELECTOR, "div.full-card__Name-sc-11z5u35-4").text
-                    
-                    # Extract URL
-                    product_url = " "
-                    try:
-                        # Attempt to find the anchor tag for the product URL
-                        url_element = tile.find_element(By.TAG_NAME, "a")
-                        product_url = url_element.get_attribute("href")
-                    except NoSuchElementException:
-                        print(f"⚠️ URL not found for product '{name}'")
-
-                    # Extract THC
-                    thc_content = " "
-                    try:
-                        thc_element = tile.find_element(By.CSS_SELECTOR, "div.full-card__Potency-sc-11z5u35-8 > div")
-                        raw_thc_text = thc_element.text
-                        thc_content = clean_thc_value(raw_thc_text) # Apply the cleaning function here
-                    except NoSuchElementException:
-                        pass # THC might not be present for all products
-
-                    # Extract Price
-                    discounted_price = " "
-                    original_price = " "
-                    try:
-                        option_tile_button = tile.find_element(By.CSS_SELECTOR, "button[data-testid='option-tile']")
-                        
-                        # First, try to find the original price span, as its presence dictates the logic
-                        try:
-                            original_price_element_if_discount = option_tile_button.find_element(By.CSS_SELECTOR, "span.optionstyles__OriginalPrice-sc-vu6uvs-2")
-                            # If this element is found, it means there's a discount
-                            original_price = original_price_element_if_discount.text
-                            # The 'b' tag then holds the discounted price
-                            discounted_price_element = option_tile_button.find_element(By.TAG_NAME, "b")
-                            discounted_price = discounted_price_element.text
-                        except NoSuchElementException:
-                            # If original_price_element_if_discount is NOT found, it means no discount
-                            # In this case, the 'b' tag holds the original price
-                            single_price_element = option_tile_button.find_element(By.TAG_NAME, "b")
-                            original_price = single_price_element.text
-                            discounted_price = " " # As per new requirement
-                            
-                    except NoSuchElementException:
-                        print(f"⚠️ Price information not found for product '{name}'")
-
-                    # Extract and normalize quantity from Site product name
-                    site_qty_num, site_qty_unit = extract_and_normalize_quantity(name)
-
-                    # Identify all parts of quantity strings from the Site product name
-                    site_quantity_parts_to_exclude = set()
-                    for m in QUANTITY_RE.finditer(name):
-                        full_match_str = m.group(0).lower()
-                        for part_token in TOKEN_RE.findall(full_match_str):
-                            site_quantity_parts_to_exclude.add(part_token.replace(" ", "").lower())
-
-                    # Identify all parts of ratio strings from the Site product name
-                    site_ratio_parts_to_exclude = set()
-                    for m in RATIO_RE.finditer(name):
-                        full_match_str = m.group(0).lower()
-                        for part_token in TOKEN_RE.findall(full_match_str):
-                            site_ratio_parts_to_exclude.add(part_token.replace(" ", "").lower())
-                    
-                    # Extract flavors from Site product name
-                    site_flavors = extract_flavors(name, FLAVOR_LIST)
-                    site_flavor_tokens = set(site_flavors) # Store as set for comparison
-
-                    raw_wb = TOKEN_RE.findall(name)
-                    collapsed_wb = [t.replace(" ", "") for t in raw_wb]
-
-                    site_weight_tokens = [
-                        t for t in collapsed_wb
-                        if re.match(r'^\d+(?:\.\d+)?(?:g|mg|oz)$', t.lower())
-                    ]
-
-                    # Filter Site tokens for keywords. Flavors are *not* excluded here.
-                    site_keyword_tokens_list = []
-                    for t in collapsed_wb:
-                        normalized_t_lower = t.lower()
-                        # Check if it's a weight token
-                        if re.match(r'^\d+(?:\.\d+)?(?:g|mg|oz)$', normalized_t_lower):
-                            continue
-                        # Check if it's part of an identified quantity
-                        if normalized_t_lower in site_quantity_parts_to_exclude:
-                            continue
-                        # Check if the token is part of an identified ratio
-                        if normalized_t_lower in site_ratio_parts_to_exclude:
-                            continue
-                        # Check if it's a brand/category/stopword token
-                        if normalized_t_lower in brand_tokens or \
-                           normalized_t_lower in STOPWORDS or \
-                           normalized_t_lower in category_tokens or \
-                           (normalized_t_lower.endswith("s") and normalized_t_lower[:-1] in category_tokens):
-                            continue
-                        # Flavors are NO LONGER EXCLUDED HERE; they will contribute to the general score.
-                        site_keyword_tokens_list.append(normalized_t_lower)
-
-                    # Add site_qty_num, site_qty_unit, and site_keyword_tokens_list to scraped tuple
-                    scraped.append((name, product_url, discounted_price, original_price, thc_content, site_weight_tokens, site_qty_num, site_qty_unit, site_flavors, site_keyword_tokens_list))
-
-            except TimeoutException:
-                st.warning(f"⚠️ No products found for brand **{brand}** in category **{selected_category}**")
-                # When no products are found, ensure N/A is written to Excel
-                save_data_to_file(row_index, " ", " ", " ", " ") # Save "N/A" for this row
+            row_indices = scrape_groups[group_key]
+            if products is None:
+                # Brand could not be selected: save empty strings for price, THC, and URL
+                # (not journaled, so resuming retries the listing)
+                for row_index in row_indices:
+                    save_data_to_file(row_index, " ", " ", " ", " ", journal=False)
                 continue
-            except Exception as e:
-                st.error(f"An error occurred while scraping product tiles: {e}")
-                save_data_to_file(row_index, " ", " ", " ", " ")
-                continue
-
-            # Initialize lists to store multiple matches if fuzzy matching
-            matched_urls = []
-            matched_discounted_prices = []
-            matched_original_prices = []
-            matched_thc_contents = []
-
-            best_match, best_score = None, 0.0
-
-            if len(excel_keyword_tokens_set) <= 3:
-                match_threshold = 0.6  # 60%
-                print("Threshold set to 60% due to <= 3 Excel tokens.")
+            if verbose_matching:
+                index = ProductIndex(products)
+                for row_index in row_indices:
+                    record_match_result(row_index, match_row_to_products(filtered_data.loc[row_index], index))
             else:
-                match_threshold = 0.75 # 75%
-                print("Threshold set to 75% due to > 3 Excel tokens.")
-
-            # Update the loop to unpack new scraped fields
-            for name, url, discounted_price, original_price, thc_content, site_weight_tokens, site_qty_num, site_qty_unit, site_flavors, site_keyword_tokens_list in scraped:
-                # --- QUANTITY COMPARISON LOGIC ---
-                quantity_match = True
-                if excel_qty_num is not None and site_qty_num is not None:
-                    if not (excel_qty_num == site_qty_num and excel_qty_unit == site_qty_unit):
-                        quantity_match = False
-                        print(f"  Quantity mismatch: Excel '{excel_qty_num} {excel_qty_unit}' vs Site '{site_qty_num} {site_qty_unit}' for '{name}'")
-
-                # if no‐weight category, enforce exact weight match before comparing
-                weight_enforced_match = True
-                if website_cat in no_weight_categories:
-                    # Normalize site_weight_tokens for consistent comparison (e.g., '1g', '500mg')
-                    normalized_site_weight_tokens = [normalize_weight(swt) for swt in site_weight_tokens]
-
-                    # Now, compare the normalized weight from the Excel 'Weight' column
-                    # (which is 'normalized_weight') against the site's normalized weight tokens.
-                    if normalized_weight not in normalized_site_weight_tokens:
-                        weight_enforced_match = False
-                        # Update print statement to show the actual Excel column weight being used
-                        print(f"  Weight mismatch for no-weight category: Excel '{normalized_weight}' vs Site '{', '.join(site_weight_tokens)}' for '{name}'")
-
-                # Flavor Matching Logic
-                flavor_match = True
-                if excel_flavors: # If there are flavors in the Excel product name
-                    # Check if ALL Excel flavors are present in the site product's flavors
-                    if not all(f in site_flavor_tokens for f in excel_flavor_tokens):
-                        flavor_match = False
-                        print(f"  Flavor mismatch: Excel '{', '.join(excel_flavors)}' vs Site '{', '.join(site_flavors) if site_flavors else 'N/A'}' for '{name}'")
-                # If Excel product has no specific flavors, then any flavor on site is acceptable.
-                # The 'flavor_match' remains True in this case, meaning no flavor mismatch prevents a match.
-
-                # Convert to set for efficient comparison
-                lc_site_keyword_tokens_set = set(site_keyword_tokens_list)
-                site_tokens_display = [t.title() for t in site_keyword_tokens_list] # For display
-
-                print(f"⚖️ **Site weight tokens for “{name}”:** {', '.join(site_weight_tokens)}")
-                print(f"📦 **Site quantity for “{name}”:** {site_qty_num} {site_qty_unit if site_qty_unit else 'N/A'}")
-                print(f"🎨 **Site flavors for “{name}”:** {', '.join(site_flavors) if site_flavors else 'N/A'}") # Display extracted site flavors
-                print(f"👁️ **Site tokens for “{name}” (cleaned):** {', '.join(site_tokens_display)}")
-                print(f"💰 **Site Price for “{name}”:** Discounted: {discounted_price}, Original: {original_price}")
-                print(f"🌿 **Site THC for “{name}”:** {thc_content}")
-                print(f"🌐 **Site URL for “{name}”:** {url}")
-
-                # compare on lowercase using the cleaned keyword token sets
-                common = [w for w in excel_keyword_tokens_set if w in lc_site_keyword_tokens_set]
-                common_tokens_display = [t.title() for t in common]
-                print(f"🔗 **Common tokens:** {', '.join(common_tokens_display)}")
-
-                # compute score based only on keyword tokens
-                if not excel_keyword_tokens_set:
-                    score = 0.0
-                else:
-                    score = len(common) / len(excel_keyword_tokens_set)
-                print(f"      Score for “{name}”: {score:.0%}")
-
-                # If quantity matched (or wasn't applicable for strict match) and keyword score is good
-                # And now, ensure weight also matched if it's a no_weight_category
-                # Ensure flavors also matched if present in Excel
-                if quantity_match and weight_enforced_match and flavor_match and score >= match_threshold:
-                    # Instead of just taking the best, collect all valid matches
-                    # This is for the scenario where multiple products could fuzzy match
-                    matched_urls.append(url)
-                    matched_discounted_prices.append(discounted_price)
-                    matched_original_prices.append(original_price)
-                    matched_thc_contents.append(thc_content)
-
-                    # Update best_match for display purposes if a higher score is found
-                    if score > best_score:
-                        best_match_name = name
-                        best_score = score
-
-            if matched_urls: # If any matches were found
-                st.success(f"✅ Matched “{target_name}” → “{best_match_name}” ({best_score:.0%})")
-                st.write(f"   **URL(s):** {', '.join(matched_urls)}")
-                st.write(f"   **Price(s):** Discounted: {', '.join(map(str, matched_discounted_prices))} (Original: {', '.join(map(str, matched_original_prices))})")
-                st.write(f"   **THC(s):** {', '.join(matched_thc_contents)}")
-                # Save the collected data for this row
-                save_data_to_file(row_index, matched_discounted_prices, matched_original_prices, matched_thc_contents, matched_urls)
-            else:
-                st.warning(f"⚠️ No ≥{int(match_threshold * 100)}% match for “{target_name}” (including quantity, weight, and flavor comparisons).")
-                # When no match, save "N/A" for the current row
-                save_data_to_file(row_index, " ", " ", " ", " ")
+                matches = match_sheet(filtered_data.loc[row_indices], {group_key: products})
+                for row_index, result in matches.iterrows():
+                    record_match_result(row_index, result)
+            timing_table.dataframe(stage_tracer.summary())
+            if time.time() - last_results_download >= 10:
+                # download works mid-run: on_click="ignore" keeps the click from rerunning the app
+                show_results_log_download(results_download, uploaded_file)
+                last_results_download = time.time()
             # --- PRODUCT MATCHING END ---
 
-            # Optionally, add a short delay or confirmation after each selection
-            time.sleep(3)
-
         st.write("Scraping completed for category:", selected_category)
 
-        driver.quit()  # Close the driver after both steps are completed
+        if driver is not None and parallel_drivers <= 1:
+            managed_driver.quit()  # Close the (possibly recycled) driver; pool workers quit their own
+            if managed_driver.recycles:
+                st.write(f"Browser recycled {managed_driver.recycles} time(s) during the run.")
 
-        # Add the download button after scraping is complete and driver is quit
-        if excel_buffer is not None:
-            st.download_button(
-                label="Download Updated Excel File",
-                data=excel_buffer.getvalue(), # Get the BytesIO content
-                file_name=f"updated_{uploaded_file.name}",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        # Write all remaining rows (AY–BB) back into the buffer in one pass
+        flush_results_to_file()
+        # The run is complete: drop its journal so re-running this sheet later scrapes fresh prices
+        run_journal.clear()
+        show_results_log_download(results_download, uploaded_file)
+        st.caption(f"Results log kept at {results_stream.finish()}")
 
-            )
+        if snapshot_cache is not None:
+            cache_stats = snapshot_cache.stats()
+            st.write(f"Listing cache: {cache_stats['hits']} hit(s), {cache_stats['misses']} miss(es) ({cache_stats['hit_rate']:.0%} hit rate)")
+
+        # Add the download button after scraping is complete and driver is quit
+        show_download_button(uploaded_file)
+
+        # Stage timings: final breakdown plus raw records as JSON lines / CSV
+        timing_table.dataframe(stage_tracer.summary())
+        st.write("Learned wait deadlines:")
+        st.dataframe(adaptive_timeouts.summary())
+        st.download_button("Download stage timings (JSON lines)", stage_tracer.to_jsonl(),
+                           file_name="stage_timings.jsonl", mime="application/jsonl")
+        st.download_button("Download stage timings (CSV)", stage_tracer.to_csv(),
+                           file_name="stage_timings.csv", mime="text/csv")
 
 
 